@@ -0,0 +1,10 @@
+#version 130
+
+out vec4 color_frag;
+
+#include "frag_lib.glsl.frag"
+
+void main()
+{
+  color_frag = secret_method();
+}
@@ -35,7 +35,8 @@ from pyglet.gl import (glCreateShader, glShaderSource, glCompileShader,
   glUniformMatrix2x4fv, glUniformMatrix3x2fv, glUniformMatrix3x4fv, 
   glUniformMatrix4x2fv, glUniformMatrix4x3fv, glGetActiveAttrib, 
   glGetAttribLocation, GLint, GLfloat, glEnableVertexAttribArray, 
-  glDisableVertexAttribArray, glGetVertexAttribiv, glVertexAttribPointer)
+  glDisableVertexAttribArray, glGetVertexAttribiv, glVertexAttribPointer,
+  glGetString)
 
 from pyglet.gl import (GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_COMPILE_STATUS,
   GL_TRUE, GL_SHADER_TYPE, GL_DELETE_STATUS, GL_INFO_LOG_LENGTH,
@@ -47,13 +48,18 @@ from pyglet.gl import (GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_COMPILE_STATUS,
   GL_FLOAT_MAT3x2, GL_FLOAT_MAT3x4, GL_FLOAT_MAT4x2, GL_FLOAT_MAT4x3,
   GL_CURRENT_PROGRAM, GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING, GL_VERTEX_ATTRIB_ARRAY_SIZE,
   GL_VERTEX_ATTRIB_ARRAY_ENABLED, GL_VERTEX_ATTRIB_ARRAY_STRIDE, 
-  GL_VERTEX_ATTRIB_ARRAY_NORMALIZED, GL_VERTEX_ATTRIB_ARRAY_TYPE)
+  GL_VERTEX_ATTRIB_ARRAY_NORMALIZED, GL_VERTEX_ATTRIB_ARRAY_TYPE, GL_VENDOR,
+  GL_RENDERER, GL_VERSION)
 
-from ctypes import c_char, c_uint, cast, POINTER, pointer, byref
-import weakref, itertools
-from collections import namedtuple
-from collections.abc import Sequence
+from ctypes import (c_char, c_char_p, c_uint, cast, POINTER, pointer, byref, sizeof,
+  addressof, memset, memmove)
+import weakref, itertools, hashlib, re, os, threading
+from collections import namedtuple, OrderedDict, deque
+from collections.abc import Sequence, Mapping
 from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import Future
+import asyncio
 
 from sys import modules
 from importlib import import_module
@@ -76,6 +82,13 @@ null_c_int = None
 #Loaded extensions name are added in here
 LOADED_EXTENSIONS = []
 
+#Shader objects owned by a ShaderObjectPool, by shader id. Used to flag the wrappers returned by ShaderProgram.shaders
+#The entries are weak, so they go away with the pooled objects
+POOLED_SHADERS = weakref.WeakValueDictionary()
+
+#Set to True by the parallel_shader_compile extension. Enable the polling of GL_COMPLETION_STATUS
+PARALLEL_COMPILE = False
+
 
 #
 # Utility function
@@ -100,12 +113,83 @@ def shader_source(data):
     if type(data) is not bytes:
         raise TypeError('Shader source must be bytes')
 
-    data_len = len(data)+1
-    arr = (c_char*data_len)(*data)
-    arr_ptr = cast(arr, POINTER(c_char))
+    # Bytes objects are immutable and always null terminated, so the pointer can
+    # target the bytes buffer directly. The pointer keeps a reference to data.
+    arr_ptr = cast(c_char_p(data), POINTER(c_char))
     
     return pointer(arr_ptr)
     
+def shader_sources(datas):
+    """
+    Convert a sequence of python strings into a **GLchar (a pointer to an array of array of GLchar)
+    Used to send many strings with one glShaderSource call. The strings are not copied.
+    """
+    for data in datas:
+        if type(data) is not bytes:
+            raise TypeError('Shader source must be bytes')
+            
+    arr = (c_char_p*len(datas))(*datas)
+    return cast(arr, POINTER(POINTER(c_char)))
+
+def source_hash(verts, frags, *extra):
+    """
+        Return an hexadecimal digest that identify a set of shader sources.
+        This is the key used by the program caches.
+        
+        verts: Sequence of vertex shader sources
+        frags: Sequence of fragment shader sources
+        extra: Additional strings mixed in the digest (ex: the driver identity)
+    """
+    if isinstance(verts, str): verts = (verts,)
+    if isinstance(frags, str): frags = (frags,)
+    
+    digest = hashlib.sha1()
+    for stage, srcs in ((b'v', verts), (b'f', frags), (b'x', extra)):
+        for src in srcs:
+            digest.update(stage)
+            for chunk in ((src,) if isinstance(src, str) else src):
+                chunk = chunk.encode('UTF-8')
+                digest.update(str(len(chunk)).encode('ascii') + b':')  # Length prefix so sources cannot bleed in each other
+                digest.update(chunk)
+            
+    return digest.hexdigest()
+    
+def driver_identity():
+    """
+        Return the (vendor, renderer, version) strings of the current opengl context.
+        Used to invalidate cached data when the driver changes.
+    """
+    return tuple(cast(glGetString(name), c_char_p).value.decode('UTF-8') 
+                 for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+    
+TRUSTED_SHADERS = False
+def trust_shaders(val):
+    """
+        If True, the loading functions only query the link status of the programs.
+        The compilation status and logs of the shader objects are only queried if the link fails.
+    """
+    global TRUSTED_SHADERS
+    TRUSTED_SHADERS = bool(val)
+    
+LAZY_REFLECTION = False
+def lazy_reflection(val):
+    """
+        If True, linking a program does not reflect its uniforms and attributes. They are reflected
+        the first time the uniforms or attributes caches are used, and the setter and getter of an uniform
+        are only created the first time the uniform is used.
+    """
+    global LAZY_REFLECTION
+    LAZY_REFLECTION = bool(val)
+    
+VERIFY_REFLECTION = False
+def verify_reflection(val):
+    """
+        If True, the reflection metadata given to ShaderProgram.restore_reflection is compared with the reflection
+        of the live program. Use this to debug persisted metadata (see the program_binary extension).
+    """
+    global VERIFY_REFLECTION
+    VERIFY_REFLECTION = bool(val)
+    
 #
 # Uniform getter/setter
 #    
@@ -114,6 +198,16 @@ TRANSPOSE_MATRIX = True
 def transpose_matrices(val):
     global TRANSPOSE_MATRIX
     TRANSPOSE_MATRIX = bool(val)
+
+DIRECT_UNIFORMS = False
+def direct_uniforms(val):
+    """
+        If True, the uniforms setters built after this call write the uniforms with the functions in PROGRAM_SETTERS
+        (glProgramUniform*) and the programs do not have to be in use when their uniforms are set.
+        Set to True by the program_uniforms extension.
+    """
+    global DIRECT_UNIFORMS
+    DIRECT_UNIFORMS = bool(val)
         
 GETTERS = {
     GLfloat: glGetUniformfv,
@@ -143,6 +237,32 @@ UNIFORMS_DATA = {
 
 UNPACK_ARRAY = [GL_FLOAT, GL_INT]
 
+MATRIX_FUNCTIONS = {
+# TypeIdentifier: (glUniformMatrix function, transpose). If transpose is None, TRANSPOSE_MATRIX is used
+  GL_FLOAT_MAT2: (glUniformMatrix2fv, None),
+  GL_FLOAT_MAT3: (glUniformMatrix3fv, None),
+  GL_FLOAT_MAT4: (glUniformMatrix4fv, None),
+  GL_FLOAT_MAT2x3: (glUniformMatrix2x3fv, None),
+  GL_FLOAT_MAT2x4: (glUniformMatrix2x4fv, None),
+  GL_FLOAT_MAT3x2: (glUniformMatrix3x2fv, None),
+  GL_FLOAT_MAT3x4: (glUniformMatrix3x4fv, None),
+  GL_FLOAT_MAT4x2: (glUniformMatrix4x2fv, None),
+  GL_FLOAT_MAT4x3: (glUniformMatrix4x3fv, None),
+}
+
+# TypeIdentifier: glProgramUniform function, called like the UNIFORMS_DATA setters or MATRIX_FUNCTIONS functions with
+# the program id as first argument. Filled by the program_uniforms extension
+PROGRAM_SETTERS = {}
+
+# Buffer protocol format characters accepted by the uniform setters, by c_type
+BUFFER_FORMATS = {
+    GLfloat: 'f',
+    GLint: 'il'
+}
+
+# Tokens of the uniforms names: array index or struct member
+PATH_TOKENS = re.compile(r'\[(\d+)\]|\.?([^.\[\]]+)')
+
 to_seq = lambda x: x if isinstance(x, Sequence) else [x] 
 
 def as_matrix(values, size):
@@ -164,92 +284,478 @@ def as_matrix(values, size):
     return tuple([tuple(i) for i in mat])
     
 
-def create_uniform_getter(loc, type, count, is_array):
+#
+# Uniforms setters/getters factories
+#
+# The setters and getters are closures specialized for a (type, count, array) signature.
+# The factory of a signature is built once and cached in SETTER_FACTORIES / GETTER_FACTORIES, the factories
+# then create the functions of every uniform that share the signature.
+#
+
+SETTER_FACTORIES = {}
+GETTER_FACTORIES = {}
+
+def register_uniform_component(c_type, getter, formats):
     """
-        Create a function that gets uniform values
+        Register a component type in the uniforms factories. Used by the uniforms extensions.
+        
+        Arguments:
+            c_type: ctypes type of the components (ex: GLuint)
+            getter: glGetUniform*v function of the component type
+            formats: Buffer protocol format characters of the component type (see BUFFER_FORMATS)
     """
-    if not type in UNIFORMS_DATA.keys():
-        return lambda x: None
+    GETTERS[c_type] = getter
+    BUFFER_FORMATS[c_type] = formats
+    
+def register_uniform_type(type, c_type, count, function, matrix_size=None, transpose=None):
+    """
+        Register an uniform type in the uniforms factories. Used by the uniforms extensions.
+        
+        Arguments:
+            type: Uniform type identifier (ex: GL_UNSIGNED_INT_VEC2)
+            c_type: ctypes type of the components
+            count: Number of components
+            function: glUniform*v or glUniformMatrix*v function called by the setters
+            matrix_size: Size of the matrices types, as in UNIFORMS_DATA
+            transpose: Transpose argument of the matrices functions. If None, TRANSPOSE_MATRIX is used.
+    """
+    if matrix_size is None:
+        UNIFORMS_DATA[type] = (c_type, count, function)
+        if count == 1 and type not in UNPACK_ARRAY:
+            UNPACK_ARRAY.append(type)
+    else:
+        MATRIX_FUNCTIONS[type] = (function, transpose)
+        if transpose is None:
+            setter = lambda x,y,z: function(x,y,TRANSPOSE_MATRIX,z)
+        else:
+            setter = lambda x,y,z: function(x,y,transpose,z)
+        UNIFORMS_DATA[type] = (c_type, count, setter, matrix_size)
+    
+    # Factories built for the previous definition of the type
+    for factories in (SETTER_FACTORIES, GETTER_FACTORIES):
+        for key in [k for k in factories.keys() if k[0] == type]:
+            del factories[key]
+
+def setter_factory(type, count, is_array, mode, direct):
+    """
+        Return the factory of the setters of a signature. The factory is built the first time.
+        
+        Arguments:
+            type, count, is_array: Signature of the uniform
+            mode: 'plain' (always write), 'shadow' (skip redundant writes) or 'deferred' (write on flush)
+            direct: If the setters call a PROGRAM_SETTERS function
+    """
+    key = (type, count, is_array, mode, direct)
+    factory = SETTER_FACTORIES.get(key)
+    if factory is not None:
+        return factory
         
     c_type, bcount, setter, *mat_size = UNIFORMS_DATA[type]
-    c_buf_type = c_type*bcount
+    is_matrix = len(mat_size) == 1
+    length = bcount*count
+    esize = sizeof(c_type)
+    nbytes, pad = length*esize, (length-1)*esize
+    c_buf_type = c_type*length
     
-    getter = GETTERS[c_type]
+    scalar = not is_array and not is_matrix
+    flat = scalar or (is_array ^ is_matrix and type in UNPACK_ARRAY)
+    nested = is_array and is_matrix         # Arrays of matrices
     
-    one_val = bcount == 1
-    is_matrix = len(mat_size) == 1
-
-    if not is_array and not is_matrix:
-        def getter_fn(pid):
-            buf = c_buf_type()
-            buf_ptr = cast(buf, POINTER(c_type))
-            getter(pid, loc, buf_ptr)
-            return buf[0] if one_val else tuple(buf)
-    elif is_matrix and not is_array:
-        def getter_fn(pid):
-            buf = c_buf_type()
-            buf_ptr = cast(buf, POINTER(c_type))
-            getter(pid, loc, buf_ptr)
-            return as_matrix(buf, mat_size[0])
-    elif is_array and not is_matrix:
-        def getter_fn(pid):
-            values = []
-            buf = c_buf_type()
-            buf_ptr = cast(buf, POINTER(c_type))
-            for i in range(count):
-                getter(pid, loc.value+i, buf_ptr)                  #Not sure if loc+1 is super legal, but it works.
-                values.append(buf[0] if one_val else tuple(buf))
+    # Matrices functions take the transpose argument. If transpose is None, TRANSPOSE_MATRIX is read on every write
+    matrix_call = is_matrix and type in MATRIX_FUNCTIONS
+    transpose = MATRIX_FUNCTIONS[type][1] if matrix_call else False
+    follow = matrix_call and transpose is None
+    
+    def make(fn, loc, pid, shadow, stats, dirty):
+        data = c_buf_type()
+        data_ptr = cast(data, POINTER(c_type))
+        data_addr = addressof(data)
+        data_view = memoryview(data).cast('B')
+        formats = BUFFER_FORMATS.get(c_type, '')
+        key = loc.value
+        
+        last = c_buf_type()
+        last_addr = addressof(last)
+        last_view = memoryview(last).cast('B')
+        states = {True: (True, last), False: (False, last)}
+        state = states[bool(transpose)]
+        
+        # Call the GL function directly
+        args = (pid, loc, count) if direct else (loc, count)
+        if not follow:
+            call = partial(fn, *args, bool(transpose)) if matrix_call else partial(fn, *args)
+        elif direct:
+            def call(src):
+                fn(pid, loc, count, TRANSPOSE_MATRIX, src)
+        else:
+            def call(src):
+                fn(loc, count, TRANSPOSE_MATRIX, src)
+        
+        # Fill the setter buffer
+        def fill_flat(value):
+            try:
+                size = len(value)
+            except TypeError:
+                value = tuple(value)      # Iterables without a length (ex: generators)
+                size = len(value)
+            if size > length:
+                raise IndexError('Too many values for uniform')
+            data[0:size] = value
+            if size < length:
+                memset(data_addr+size*esize, 0, (length-size)*esize)
                 
-            return tuple(values)
-    else:
-        def getter_fn(pid):
-            values = []
-            buf = c_buf_type()
-            buf_ptr = cast(buf, POINTER(c_type))
-            for i in range(count):
-                getter(pid, loc.value+i, buf_ptr)                  #Not sure if loc+1 is super legal, but it works.
-                values.append(as_matrix(buf, mat_size[0]))
+        def fill_scalar(value):
+            data[0] = value
+            if pad:
+                memset(data_addr+esize, 0, pad)
                 
-            return tuple(values)
+        def fill_rows(value):
+            i = 0
+            for row in (itertools.chain.from_iterable(value) if nested else value):
+                try:
+                    j = i+len(row)
+                except TypeError:
+                    row = tuple(row)
+                    j = i+len(row)
+                if j > length:
+                    raise IndexError('Too many values for uniform')
+                data[i:j] = row
+                i = j
+            if i < length:
+                memset(data_addr+i*esize, 0, (length-i)*esize)
+                
+        if scalar:
+            fill_sequence, fill_number = fill_flat, fill_scalar
+            def fill(value):
+                if isinstance(value, Sequence):
+                    fill_flat(value)
+                else:
+                    fill_scalar(value)
+        else:
+            fill = fill_sequence = fill_flat if flat else fill_rows
+            fill_number = None
+            
+        def source(value):
+            try:
+                view = memoryview(value)
+            except TypeError:
+                view = None
+                
+            if (view is not None and view.nbytes == nbytes and view.itemsize == esize and
+              view.format[-1] in formats and view.format[0] not in '>!'):
+                if not view.c_contiguous:
+                    memmove(data_addr, view.tobytes(), nbytes)
+                elif view.readonly:
+                    data_view[:] = view.cast('B')
+                else:
+                    return c_buf_type.from_buffer(view)
+                return data_ptr
+                
+            fill(value)
+            return data_ptr
+            
+        # Send the value
+        def write_shadow(src):
+            src_view = data_view if src is data_ptr else memoryview(src).cast('B')
+            current = states[TRANSPOSE_MATRIX] if follow else state
+            if shadow.get(key) is current and src_view == last_view:
+                stats.skipped += 1
+                return
+            call(src)
+            memmove(last_addr, src, nbytes)
+            shadow[key] = current
+            stats.issued += 1
+            
+        # Deferred value. The setter buffer is only copied once it is filled, so a failed write keeps the pending value
+        staged = c_buf_type() if mode == 'deferred' else None
+        
+        def upload():
+            write_shadow(staged)
+            
+        pending = (upload, staged)
+        
+        def write_deferred(src):
+            memmove(staged, src, nbytes)
+            dirty[key] = pending
+            
+        write = {'plain': call, 'shadow': write_shadow, 'deferred': write_deferred}[mode]
+        
+        def setter_fn(value):
+            cls = value.__class__
+            if cls is tuple or cls is list:
+                fill_sequence(value)
+                write(data_ptr)
+            elif fill_number is not None and (cls is float or cls is int):
+                fill_number(value)
+                write(data_ptr)
+            else:
+                write(source(value))
+                
+        return setter_fn
+        
+    factory = SETTER_FACTORIES[key] = make
+    return factory
     
+def getter_factory(type, count, is_array):
+    """
+        Return the factory of the getters of a signature. The factory is built the first time.
+    """
+    key = (type, count, is_array)
+    factory = GETTER_FACTORIES.get(key)
+    if factory is not None:
+        return factory
         
-    return getter_fn
+    c_type, bcount, setter, *mat_size = UNIFORMS_DATA[type]
+    c_buf_type = c_type*bcount
     
-def create_uniform_setter(loc, type, count, is_array):
+    if len(mat_size) == 1:
+        # Same result as as_matrix
+        row, col = mat_size[0]
+        def value(buf):
+            m = []
+            for i in range(col):
+                m += buf[i::col]
+            return tuple([tuple(m[i*col:(i+1)*col]) for i in range(row)])
+    elif bcount == 1:
+        def value(buf):
+            return buf[0]
+    else:
+        value = tuple
+        
+    def make(getter, loc, locations):
+        buf = c_buf_type()
+        buf_ptr = cast(buf, POINTER(c_type))
+        
+        if is_array:
+            def getter_fn(pid):
+                values = []
+                for element_loc in locations():
+                    getter(pid, element_loc, buf_ptr)
+                    values.append(value(buf))
+                return tuple(values)
+        else:
+            def getter_fn(pid):
+                getter(pid, loc, buf_ptr)
+                return value(buf)
+                
+        return getter_fn
+        
+    factory = GETTER_FACTORIES[key] = make
+    return factory
+
+def create_uniform_getter(loc, type, count, is_array, locations=None):
     """
-        Generate a function that set an uniform.
+        Create a function that gets uniform values. See getter_factory.
+        
+        locations is a function that returns the location of every element of an array.
+        By default, the elements locations are assumed to be consecutive.
     """
     if not type in UNIFORMS_DATA.keys():
         return lambda x: None
+        
+    if locations is None:
+        locations = lambda: range(loc.value, loc.value+count)
+        
+    c_type = UNIFORMS_DATA[type][0]
+    return getter_factory(type, count, is_array)(GETTERS[c_type], loc, locations)
     
-    c_type, bcount, setter, *mat_size = UNIFORMS_DATA[type]
-    c_buf_type = c_type*(bcount*count)
-    is_matrix = len(mat_size) == 1
+def uniform_buffer_view(buffer, c_type, length):
+    """
+        Return a writable memoryview of the "length" first items of a buffer used to read
+        uniforms values. The buffer items must match c_type (see BUFFER_FORMATS).
+    """
+    view = memoryview(buffer)
+    if view.readonly or not view.c_contiguous:
+        raise ValueError('Buffer must be writable and C contiguous')
+    if view.itemsize != sizeof(c_type) or view.format[-1] not in BUFFER_FORMATS.get(c_type, ''):
+        raise TypeError('Buffer format "{}" does not match the uniform type'.format(view.format))
+    if view.nbytes < length*sizeof(c_type):
+        raise ValueError('Buffer is too small, {} items are required'.format(length))
+        
+    return view.cast('B').cast(c_type._type_)[0:length]
     
-    if not is_array and not is_matrix:
-        def setter_fn(value):
-            data = c_buf_type(*to_seq(value))
-            data_ptr = cast(data, POINTER(c_type))
-            setter(loc, count, data_ptr)
+def transpose_matrices_into(dst, src, size, row_major):
+    """
+        Copy the matrices of src in dst, converting their layout. If row_major is True,
+        the matrices in src are row major and are copied column major, and inversely.
+        
+        Arguments:
+            dst, src: Memoryviews of the same length
+            size: Matrix size (columns, rows)
+            row_major: Layout of src
+    """
+    cols, rows = size
+    stride = cols*rows
+    for c in range(cols):
+        for r in range(rows):
+            if row_major:
+                dst[c*rows+r::stride] = src[r*cols+c::stride]
+            else:
+                dst[r*cols+c::stride] = src[c*rows+r::stride]
+
+class UniformStats(object):
+    """
+        Counters of the uniform writes of a program. Writes that do not change
+        the value of a uniform are skipped and never reach OpenGL.
+        
+        Slots:
+            issued: Number of glUniform calls sent to OpenGL
+            skipped: Number of redundant writes that were dropped
+    """
+    
+    __slots__ = ['issued', 'skipped']
+    
+    def __init__(self):
+        self.issued = 0
+        self.skipped = 0
+        
+    def reset(self):
+        " Set the counters back to zero "
+        self.issued = 0
+        self.skipped = 0
+        
+    def __repr__(self):
+        return 'UniformStats(issued={}, skipped={})'.format(self.issued, self.skipped)
+
+def uniform_function(type, pid=None):
+    """
+        Return the OpenGL function used to write an uniform type as a (function, direct) tuple.
+        If direct is True, the function is the PROGRAM_SETTERS function of the type and takes the program id as first argument.
+        Matrices functions (see MATRIX_FUNCTIONS) also take the transpose argument.
+    """
+    is_matrix = len(UNIFORMS_DATA[type]) == 4
+    if is_matrix and type in MATRIX_FUNCTIONS:
+        fn = MATRIX_FUNCTIONS[type][0]
+    else:
+        fn = UNIFORMS_DATA[type][2]
+    
+    direct = (pid is not None and DIRECT_UNIFORMS and type in PROGRAM_SETTERS and
+              (not is_matrix or type in MATRIX_FUNCTIONS))
+    if direct:
+        fn = PROGRAM_SETTERS[type]
+        
+    return fn, direct
+    
+def create_uniform_writer(type, pid=None):
+    """
+        Return a function write(location, count, pointer) that sends "count" elements of an uniform type
+        starting at "location". Used to write parts of uniform arrays.
+    """
+    fn, direct = uniform_function(type, pid)
+    if not (type in MATRIX_FUNCTIONS and len(UNIFORMS_DATA[type]) == 4):
+        return partial(fn, pid) if direct else fn
+        
+    transpose = MATRIX_FUNCTIONS[type][1]
+    def write(loc, count, ptr):
+        row_major = TRANSPOSE_MATRIX if transpose is None else transpose
+        if direct:
+            fn(pid, loc, count, row_major, ptr)
+        else:
+            fn(loc, count, row_major, ptr)
             
-    elif is_array ^ is_matrix:
-        unpack = False if type in UNPACK_ARRAY else True
-        def setter_fn(value):
-            flat = value if not unpack else list(itertools.chain.from_iterable(value))
-            data = c_buf_type(*flat)
-            data_ptr = cast(data, POINTER(c_type))
-            setter(loc, count, data_ptr)
+    return write
+    
+def uniform_elements(values, type):
+    """
+        Copy elements of an uniform array in a new ctypes array. Return the array and the number of elements.
+        Values is a sequence of elements (using the same format as the uniform setters) or an object
+        supporting the buffer protocol with a format matching the uniform type (see BUFFER_FORMATS).
+    """
+    c_type, bcount, setter, *mat_size = UNIFORMS_DATA[type]
+    esize = sizeof(c_type)
+    
+    try:
+        view = memoryview(values)
+    except TypeError:
+        view = None
+        
+    if view is not None:
+        if (view.itemsize != esize or view.format[-1] not in BUFFER_FORMATS.get(c_type, '') or 
+          view.format[0] in '>!' or view.nbytes % (esize*bcount) != 0):
+            raise TypeError('Buffer format does not match the uniform type')
             
+        data = (c_type*(view.nbytes//esize))()
+        memoryview(data).cast('B')[:] = view.cast('B') if view.c_contiguous else view.tobytes()
+        return data, view.nbytes//(esize*bcount)
+        
+    values = tuple(values)
+    if len(mat_size) == 1:
+        flat = [v for element in values for row in element for v in row]
+    elif bcount == 1:
+        flat = values
     else:
-        # for arrays of matrices
-        def setter_fn(value):
-            flat = [list(itertools.chain.from_iterable(mat)) for mat in value]
-            flat = list(itertools.chain.from_iterable(flat))
-            data = c_buf_type(*flat)
-            data_ptr = cast(data, POINTER(c_type))
-            setter(loc, count, data_ptr)
+        flat = [v for element in values for v in element]
         
-    return setter_fn
+    if len(flat) != len(values)*bcount:
+        raise ValueError('Elements values do not match the uniform type')
+        
+    return (c_type*len(flat))(*flat), len(values)
+    
+def uniform_path(name):
+    """
+        Split the name of an uniform in a path of struct members names and arrays indices.
+        Ex: 'lights[1].color' is ('lights', 1, 'color')
+    """
+    return tuple(int(index) if index else field for index, field in PATH_TOKENS.findall(name))
+    
+def uniform_name(path):
+    " Return the name of an uniform from its path (see uniform_path) "
+    name = path[0]
+    for key in path[1:]:
+        name += '[{}]'.format(key) if isinstance(key, int) else '.'+key
+    return name
+    
+def uniform_field(value, key):
+    """
+        Return a member of the value of a struct (key is a name) or an element of the value of an array (key is an index).
+        Members are read with value[key] from mappings and numpy structured arrays, and with getattr from other objects.
+    """
+    if isinstance(key, int) or isinstance(value, Mapping) or getattr(getattr(value, 'dtype', None), 'names', None):
+        return value[key]
+    return getattr(value, key)
+    
+def create_uniform_setter(loc, type, count, is_array, shadow=None, stats=None, pid=None, dirty=None):
+    """
+        Generate a function that set an uniform. See setter_factory.
+        
+        If dirty is a dict, the setter is deferred: the value is only copied in the setter buffer and
+        an (upload function, buffer) tuple is saved in dirty (using the uniform location as key). Calling the upload functions sends
+        the last values to OpenGL.
+        
+        If pid is the program id and DIRECT_UNIFORMS is True, the uniform is written with the
+        PROGRAM_SETTERS function of its type and the program does not need to be in use.
+        
+        Each setter owns a preallocated buffer that is filled in place, so setting
+        an uniform does not allocate any ctypes object.
+        
+        Objects that support the buffer protocol (ex: numpy arrays) are sent without being
+        iterated if their format matches the uniform type (see BUFFER_FORMATS) and if
+        their size matches the uniform size. Writable C-contiguous buffers are passed directly to OpenGL,
+        other buffers are copied in their logical (C) order, so a fortran ordered matrix has the same meaning as
+        a C ordered matrix or a nested tuple, whatever the TRANSPOSE_MATRIX value.
+        
+        If shadow is a dict, the setter saves the last value sent to OpenGL in it as a (TRANSPOSE_MATRIX, buffer) tuple, using
+        the uniform location as key, and skips the writes that would not change the uniform value. Removing the location from the dict
+        forces the next write. The number of issued and skipped calls are counted in stats (an UniformStats object).
+    """
+    if not type in UNIFORMS_DATA.keys():
+        return lambda x: None
+        
+    fn, direct = uniform_function(type, pid)
+    if dirty is not None:
+        mode = 'deferred'
+    elif shadow is not None:
+        mode = 'shadow'
+    else:
+        mode = 'plain'
+        
+    if shadow is None:
+        shadow = {}
+    if stats is None:
+        stats = UniformStats()
+        
+    factory = setter_factory(type, count, is_array, mode, direct)
+    return factory(fn, loc, pid, shadow, stats, dirty)
 
 # Classes
 #
@@ -304,8 +810,9 @@ class ShaderObject(object):
         Slots
             sid: Underlying opengl shader id. 
             owned: If the object owns the underlying shader
+            pooled: If the underlying shader belongs to a ShaderObjectPool. Programs never take the ownership of these.
     """
-    __slots__ = ['sid', 'owned']
+    __slots__ = ['sid', 'owned', 'pooled', '__weakref__']
     
     type = GetShaderObject(GL_SHADER_TYPE)    
     delete_status = GetShaderObject(GL_DELETE_STATUS)
@@ -323,12 +830,14 @@ class ShaderObject(object):
         """
         self.sid = c_uint(getattr(shader_id, 'value', shader_id))
         self.owned = owned
+        self.pooled = False
     
     @staticmethod
     def __alloc(cls, shader_type): 
         sobj = super().__new__(cls)
         sobj.sid = c_uint(glCreateShader(shader_type))
         sobj.owned = True
+        sobj.pooled = False
         return sobj
     
     @classmethod
@@ -347,6 +856,14 @@ class ShaderObject(object):
         """
         return ShaderObject.__alloc(cls, GL_FRAGMENT_SHADER)
         
+    @classmethod
+    def new_shader(cls, shader_type):
+        """
+        Class method, create a new uninitialized shader of the selected type
+        (ex: GL_VERTEX_SHADER). The shaderobject owns the gl resource.
+        """
+        return ShaderObject.__alloc(cls, shader_type)
+        
     @property
     def source(self):
         src = read_opengl_array(self.sid, self.source_length, glGetShaderSource)
@@ -354,7 +871,15 @@ class ShaderObject(object):
         
     @source.setter
     def source(self, src):
-        glShaderSource(self.sid, 1, shader_source(src.encode('UTF-8')), null_c_int)
+        """
+            Set the shader source. The source can be a string or a sequence of strings.
+            A sequence is sent as is to glShaderSource (ex: a preamble and a body)
+        """
+        if isinstance(src, str):
+            glShaderSource(self.sid, 1, shader_source(src.encode('UTF-8')), null_c_int)
+        else:
+            chunks = [chunk.encode('UTF-8') for chunk in src]
+            glShaderSource(self.sid, len(chunks), shader_sources(chunks), null_c_int)
         
     @property
     def logs(self):
@@ -404,22 +929,44 @@ class ShaderAccessor(object):
             prog: Weakref to the uniforms shader program
             cache: Data about the attributes
             cache_type: Type of data in cache
+            _resources: (name, type, size, location) of the resources in the cache, as returned by query
     """
     
-    __slots__ = ['prog', 'cache_type', 'cache']
+    __slots__ = ['prog', 'cache_type', 'cache', '_resources']
     
     def __init__(self, program):
         self.prog = weakref.ref(program)   
         self.cache = {}
+        self._resources = ()
         
-    def reload(self, maxlength, count, fn, locfn):
+    def reload(self, maxlength, count, fn, locfn, resources=None, verify=False):
         """
-            Template to reload a cache of uniforms or attributes
+            Template to reload a cache of uniforms or attributes.
+            
+            If resources is not None, the cache is built from these (name, type, size, location) values instead of querying the program.
+            If verify is True, the resources are compared with the program resources and a ValueError is raised if they differ.
         """
         prog = self.prog()
         if prog is None:
             raise RuntimeError('Shader was freed')
         
+        if resources is None:
+            resources = self.query(prog, maxlength, count, fn, locfn)
+        else:
+            resources = [tuple(r) for r in resources]
+            if verify and sorted(resources) != sorted(self.query(prog, maxlength, count, fn, locfn)):
+                raise ValueError('Reflection metadata does not match the program')
+            
+        self.cache = {}
+        self._resources = tuple(resources)
+        for name, type, size, loc in self._resources:
+            self.cache_item_build(GLint(loc), size, name, type)    #Location kept in a c_int to quickly send the value when setting
+            
+    def query(self, prog, maxlength, count, fn, locfn):
+        """
+            Return the (name, type, size, location) of the active uniforms or attributes of a program. 
+            The program_interface_query extension replaces this with glGetProgramResourceiv queries.
+        """
         maxlength = getattr(prog, maxlength)
         name_buf = (c_char*maxlength)()
         name_buf_ptr = cast(name_buf, POINTER(c_char))
@@ -427,19 +974,30 @@ class ShaderAccessor(object):
         name_buf_length = GLint(0) 
         buf_size = GLint(0) 
         
-        self.cache = {}
+        resources = []
         for i in range(getattr(prog, count)):
             fn(prog.pid, i, maxlength, byref(name_buf_length), byref(buf_size), byref(type_buf), name_buf_ptr)
+            name = name_buf[0:name_buf_length.value].decode('UTF-8')
+            resources.append((name, type_buf.value, buf_size.value, locfn(prog.pid, name_buf_ptr)))
             
-            type = type_buf.value
-            name_len = name_buf_length.value
-            name = bytes(name_buf)[0:name_len].decode('UTF-8')
-            size = buf_size.value 
-            
-            loc = GLint(locfn(prog.pid, name_buf_ptr))   #Kept in a c_int to quickly send the value when setting  
-            
-            self.cache_item_build(loc, size, name, type)
+        return resources
 
+    def reset(self):
+        """
+            Remove the cache. It is reloaded the first time it is used. 
+            Called by ShaderProgram.reload in lazy mode (see lazy_reflection)
+        """
+        for name in ('cache', '_resources'):
+            try:
+                delattr(self, name)
+            except AttributeError:
+                pass
+            
+    def reflect(self, name):
+        " Reload the cache removed by reset and return the attribute 'name' (cache or _resources) "
+        self.reload()
+        return getattr(self, name)
+        
     def cache_item_build(self):
         raise NotImplementedError("Should be implemented in a subclass")
         
@@ -534,73 +1092,655 @@ class ShaderAttributeAccessor(ShaderAccessor):
         
         self.cache[name] = attribinfo   
         
-    def reload(self):
+    def reload(self, resources=None, verify=False):
         """
             Reload or build for the first time the attribute cache.
             This can be quite expensive so it is only done on shader linking.
             If the shader was linked outside the api, you have to call this manually.
+            
+            See ShaderProgram.restore_reflection for the resources and verify arguments.
         """
         super().reload('max_attribute_length', 'attributes_count',
-                       glGetActiveAttrib, glGetAttribLocation)  
+                       glGetActiveAttrib, glGetAttribLocation, resources, verify)  
         
     def __getattr__(self, name):
+        if name in ('cache', '_resources'):
+            return self.reflect(name)
         return self[name]
 
+class UniformStruct(object):
+    """
+        Struct, array of structs or array of arrays uniform. Built from the names of the uniforms
+        reported by OpenGL (ex: 'lights[0].color', 'lights[0].intensity', ...) when the uniforms cache is reloaded.
+        
+        The setters of every uniform under the struct are collected once in a batch. Setting a struct
+        reads all the members values (see uniform_field) before the first one is sent, so a missing member does not
+        leave the struct half written.
+        
+        Slots:
+            name: Name of the struct. Ex: 'lights' or 'lights[1].material'
+            pid: Id of the program
+            fields: Members of a struct by name or elements of an array by index. Values are UniformStruct or uniforms informations.
+            paths: Path of every uniform under the struct, relative to the struct, in location order
+            setters: Setter of every uniform in paths
+    """
+    
+    __slots__ = ['name', 'pid', 'fields', 'paths', 'setters']
+    
+    def __init__(self, name, pid):
+        self.name = name
+        self.pid = pid
+        self.fields = OrderedDict()
+        self.paths = ()
+        self.setters = ()
+        
+    @staticmethod
+    def from_cache(cache, pid):
+        " Build the structs of a uniforms cache. Return a dict of the top level structs by name. "
+        roots = {}
+        for name, info in sorted(cache.items(), key=lambda item: item[1].loc.value):
+            path = uniform_path(name)
+            if len(path) == 1 or info.loc.value == -1:     # Uniform blocks members have no location
+                continue
+                
+            node = roots.get(path[0])
+            if node is None:
+                node = roots[path[0]] = UniformStruct(path[0], pid)
+                
+            for i in range(1, len(path)-1):
+                child = node.fields.get(path[i])
+                if child is None:
+                    child = node.fields[path[i]] = UniformStruct(uniform_name(path[:i+1]), pid)
+                node = child
+                
+            node.fields[path[-1]] = info
+            
+        for node in roots.values():
+            node.build()
+            
+        return roots
+        
+    @property
+    def is_array(self):
+        " If the fields are the elements of an array "
+        return isinstance(next(iter(self.fields)), int)
+        
+    def build(self):
+        " Collect the setters of the uniforms under the struct "
+        paths, setters = [], []
+        for key, child in self.fields.items():
+            if isinstance(child, UniformStruct):
+                child.build()
+                paths.extend((key,)+path for path in child.paths)
+                setters.extend(child.setters)
+            else:
+                paths.append((key,))
+                setters.append(child.set)
+                
+        self.paths, self.setters = tuple(paths), tuple(setters)
+        
+    def set(self, value):
+        """
+            Set every uniform under the struct from a python object, a mapping or a numpy structured array.
+            Arrays of structs are set from sequences.
+        """
+        values = []
+        for path in self.paths:
+            member = value
+            for key in path:
+                member = uniform_field(member, key)
+            values.append(member)
+            
+        for set, member in zip(self.setters, values):
+            set(member)
+            
+    def get(self):
+        """
+            Return the value of the struct as a dict of the members values, or as a tuple
+            for arrays. Elements that are not active in the program are None.
+        """
+        values = {}
+        for key, child in self.fields.items():
+            values[key] = child.get() if isinstance(child, UniformStruct) else child.get(self.pid)
+            
+        if self.is_array:
+            return tuple(values.get(i) for i in range(max(values.keys())+1))
+        return values
+        
+    def __getitem__(self, key):
+        " Return a member of the struct (or an element of an array) as an UniformStruct or as uniform informations "
+        return self.fields[key]
+        
+    def __repr__(self):
+        return "UniformStruct {}".format(self.name)
+        
+
+class UniformHandle(object):
+    """
+        Pre-resolved uniform returned by ShaderUniformAccessor.handle. set and get are the
+        functions of the uniform, bound once, so calling them does not resolve the name.
+        
+        When the program is linked again, the handle is bound to the new uniform. If the uniform
+        is no longer in the program, set and get raise a RuntimeError.
+        
+        Slots:
+            name: Name of the uniform
+            loc: Location of the uniform, or None if the handle is invalid
+            type: Type of the uniform
+            size: Size of the uniform
+            set: Set the uniform value. Ex: handle.set(value)
+            get: Return the uniform value. Ex: handle.get()
+            set_range: Set elements of an uniform array. Ex: handle.set_range(start, values). See ShaderUniformAccessor.set_range
+    """
+    
+    __slots__ = ['name', 'loc', 'type', 'size', 'set', 'get', 'set_range']
+    
+    def __init__(self, name):
+        self.name = name
+        self.release()
+        
+    def bind(self, info, pid, set_range):
+        " Bind the handle to an uniform of the cache "
+        self.loc, self.type, self.size = info.loc, info.type, info.size
+        self.set = info.set
+        self.get = partial(info.get, pid)
+        self.set_range = set_range
+        
+    def release(self):
+        " Invalidate the handle "
+        def invalid(*args):
+            raise RuntimeError('Uniform "{}" is no longer in the program'.format(self.name))
+            
+        self.loc, self.type, self.size = None, None, 0
+        self.set = self.get = self.set_range = invalid
+        
+    def __setitem__(self, key, values):
+        """
+            Set elements of an uniform array. Only the modified elements are sent.
+            
+                handle[2] = (1.0, 0.0, 0.0, 1.0)
+                handle[4:8] = values
+        """
+        if self.loc is None:
+            return self.set_range(key, values)
+        elif not isinstance(key, slice):
+            index = key+self.size if key < 0 else key
+            return self.set_range(index, (values,))
+            
+        start, stop, step = key.indices(self.size)
+        if step != 1:
+            raise ValueError('Extended slices are not supported')
+            
+        data, count = uniform_elements(values, self.type)
+        if count != max(stop-start, 0):
+            raise ValueError('Expected {} elements, got {}'.format(max(stop-start, 0), count))
+        self.set_range(start, data)
+        
+    def __bool__(self):
+        return self.loc is not None
+        
+    def __repr__(self):
+        return "UniformHandle {}".format(self.name)
+        
+
 class ShaderUniformAccessor(ShaderAccessor):
     """
         Allow pythonic access to a shader uniforms.
         This object is created with a shaderprogram and should not be instanced manually.
+        
+        The attributes of the accessor (ex: stats, flush, reload) hide the uniforms with the same name
+        when they are read. Use handle to access these uniforms.
+        
+        Slots:
+            _shadow: Last values sent to OpenGL, by location: (TRANSPOSE_MATRIX, ctypes buffer). Used to skip redundant writes.
+            _stats: Number of issued and skipped uniform writes (UniformStats)
+            _deferred: If the uniforms writes are deferred until the next flush
+            _dirty: Upload functions and values of the uniforms modified since the last flush, by location
+            _locations: Cache of the arrays elements locations, by name
+            _writers: Cache of the functions that write the elements of the arrays (see create_uniform_writer), by name
+            _handles: Handles returned by handle, by name
+            _ranges: Pending range writes of the arrays in deferred mode, by location: (pending, set of dirty elements)
+            _structs: Structs uniforms (UniformStruct), by name
+            _lazy: (location, size, type, is_array) of the uniforms whose setter and getter were not created yet, by name
     """
     
-    __slots__ = []
+    __slots__ = ['_shadow', '_stats', '_deferred', '_dirty', '_locations', '_writers', '_handles', '_ranges', '_structs', '_lazy']
 
     uinfo = namedtuple('Uniform', ['loc', 'type', 'size', 'name', 'get', 'set'])
         
     def __init__(self, program):
         super().__init__(program)
         self.cache_type = ShaderUniformAccessor.uinfo
+        self._shadow = {}
+        self._stats = UniformStats()
+        self._deferred = False
+        self._dirty = {}
+        self._locations = {}
+        self._writers = {}
+        self._handles = {}
+        self._ranges = {}
+        self._structs = {}
+        self._lazy = {}
+        
+    @property
+    def stats(self):
+        " Number of issued and skipped uniform writes (UniformStats) "
+        return self._stats
         
     def cache_item_build(self, loc, size, name, type):
         """
             Add an item to the cache. This is called by reload.
         """
-        if size == 1 and not '[0]' in name:                         #Arrays name ends with [0]. Ex: 'int[5] foo' name is 'foo[0]'
-            is_array = False
-        else:
-            name = name.replace('[0]', '')
+        if name.endswith('[0]'):                         #Arrays name ends with [0]. Ex: 'int[5] foo' name is 'foo[0]'
+            name = name[:-3]
             is_array = True
+        else:
+            is_array = size != 1
             
-        set = create_uniform_setter(loc, type, size, is_array)
-        get = create_uniform_getter(loc, type, size, is_array)
+        if LAZY_REFLECTION:
+            self._lazy[name] = (loc, size, type, is_array)
+            set, get = partial(self.lazy_set, name), partial(self.lazy_get, name)
+        else:
+            set, get = self.create_functions(loc, size, name, type, is_array)
         
         uinfo = self.uinfo(loc=loc, type=type, name=name, size=size,
                            get=get, set=set)
         self.cache[name] = uinfo   
         
-    def reload(self):
+    def create_functions(self, loc, size, name, type, is_array):
+        " Return the setter and the getter of an uniform "
+        dirty = self._dirty if self._deferred else None
+        set = create_uniform_setter(loc, type, size, is_array, self._shadow, self._stats, self.prog().pid, dirty)
+        get = create_uniform_getter(loc, type, size, is_array, partial(self.element_locations, name))
+        return set, get
+        
+    def build(self, name):
+        " Return the informations of an uniform. Create its setter and getter if they were not created yet (see lazy_reflection) "
+        item = self._lazy.pop(name, None)
+        if item is None:
+            return self.cache[name]
+            
+        loc, size, type, is_array = item
+        set, get = self.create_functions(loc, size, name, type, is_array)
+        uinfo = self.cache[name] = self.cache[name]._replace(set=set, get=get)
+        return uinfo
+        
+    def lazy_set(self, name, value):
+        " Setter of the uniforms in lazy mode "
+        return self.build(name).set(value)
+        
+    def lazy_get(self, name, pid):
+        " Getter of the uniforms in lazy mode "
+        return self.build(name).get(pid)
+        
+    def reload(self, resources=None, verify=False):
         """
             Reload or build for the first time the uniforms cache.
             This can be quite expensive so it is only done on shader linking.
             If the shader was linked outside the api, you have to call this manually.
+            
+            See ShaderProgram.restore_reflection for the resources and verify arguments.
         """
+        self.invalidate()
+        self._dirty.clear()
+        self._ranges.clear()
+        self._locations.clear()
+        self._writers.clear()
+        self._lazy.clear()
         super().reload('max_uniform_length', 'uniforms_count',
-                       glGetActiveUniform, glGetUniformLocation)  
-        
-    def __getattr__(self, name):
+                       glGetActiveUniform, glGetUniformLocation, resources, verify)  
+        self.bind()
         
-        if name in self.cache.keys():
-            prog = self.prog()
-            if prog is None:
-                raise RuntimeError('Shader was freed')
-            return self.cache.get(name).get(prog.pid)
-                
-        raise AttributeError('No uniform named "{}" found'.format(name))
+    def rebuild(self):
+        """
+            Create the setters and getters of the uniforms again from the reflected resources,
+            without querying the program. Called by defer.
+        """
+        resources = self._resources
+        self._lazy.clear()
+        self.cache = {}
+        for name, type, size, loc in resources:
+            self.cache_item_build(GLint(loc), size, name, type)
+        self.bind()
+        
+    def bind(self):
+        " Build the structs of the cache and bind the handles to the new uniforms. Used internally. "
+        pid = self.prog().pid
+        self._structs = UniformStruct.from_cache(self.cache, pid)
+        for name, handle in self._handles.items():
+            info = self.cache.get(name)
+            if info is None:
+                handle.release()
+            else:
+                handle.bind(self.build(name), pid, partial(self.set_range, name))
+        
+    def reset(self):
+        """
+            Remove the cache. It is reloaded the first time it is used (see lazy_reflection).
+            The cache is reloaded immediately if handles were created.
+        """
+        if self._handles:
+            return self.reload()
+            
+        self.invalidate()
+        self._dirty.clear()
+        self._ranges.clear()
+        self._locations.clear()
+        self._writers.clear()
+        self._lazy.clear()
+        self._structs = {}
+        super().reset()
+        
+    def struct(self, name):
+        """
+            Return the UniformStruct of a struct, array of structs or array of arrays uniform.
+            Ex: uniforms.struct('lights')[2]['color']
+        """
+        self.cache    # Reflect the uniforms in lazy mode
+        struct = self._structs.get(name)
+        if struct is None:
+            raise AttributeError('No struct uniform named "{}" found'.format(name))
+        return struct
+        
+    def handle(self, name):
+        """
+            Return a UniformHandle for an uniform. The handle calls the uniform setter and getter
+            without resolving the name, use it when an uniform is set in a hot loop.
+            Handles stay valid when the program is linked again. The same handle is returned for a name.
+        """
+        handle = self._handles.get(name)
+        if handle is not None:
+            return handle
+            
+        if name not in self.cache:
+            raise AttributeError('No uniform named "{}" found'.format(name))
+            
+        prog = self.prog()
+        if prog is None:
+            raise RuntimeError('Shader was freed')
+            
+        info = self.build(name)
+        handle = self._handles[name] = UniformHandle(name)
+        handle.bind(info, prog.pid, partial(self.set_range, name))
+        return handle
+        
+    def element_locations(self, name):
+        """
+            Return the locations of the elements of an uniform. The locations of the elements
+            of an array are not always consecutive, so they are queried the first time this is called.
+        """
+        locations = self._locations.get(name)
+        if locations is not None:
+            return locations
+            
+        info = self.cache.get(name)
+        if info is None:
+            raise AttributeError('No uniform named "{}" found'.format(name))
+            
+        prog = self.prog()
+        if prog is None:
+            raise RuntimeError('Shader was freed')
+            
+        locations = [info.loc.value]
+        for i in range(1, info.size):
+            element_name = '{}[{}]'.format(name, i).encode('UTF-8')
+            locations.append(glGetUniformLocation(prog.pid, element_name))
+            
+        locations = self._locations[name] = tuple(locations)
+        return locations
+        
+    def writer(self, name):
+        " Return the function that writes the elements of an uniform array. It is created the first time this is called. "
+        write = self._writers.get(name)
+        if write is None:
+            write = self._writers[name] = create_uniform_writer(self.cache[name].type, self.prog().pid)
+        return write
+        
+    def read(self, name, out=None, shadow=False):
+        """
+            Copy the value of an uniform in a buffer and return the buffer. The values are flat and
+            matrices use the same layout as the setters (see transpose_matrices), so the buffer can be assigned back to the uniform.
+            
+            Arguments:
+                name: Name of the uniform
+                out: Writable buffer that receives the values (ex: a numpy array). If None, a ctypes array is created.
+                shadow: If True, the value is read from the client side copy of the uniform if it is known,
+                        without any OpenGL call. Pending deferred values are returned first.
+        """
+        info = self.cache.get(name)
+        if info is None:
+            raise AttributeError('No uniform named "{}" found'.format(name))
+        if info.type not in UNIFORMS_DATA:
+            raise TypeError('Uniform type {} is not supported'.format(info.type))
+            
+        c_type, bcount, setter, *mat_size = UNIFORMS_DATA[info.type]
+        length = bcount*info.size
+        if out is None:
+            out = (c_type*length)()
+        dst = uniform_buffer_view(out, c_type, length)
+        
+        key, src, row_major = info.loc.value, None, TRANSPOSE_MATRIX
+        if shadow and key in self._dirty:
+            src = self._dirty[key][1]
+        elif shadow and key in self._shadow:
+            row_major, src = self._shadow[key]
+            
+        if src is None:
+            prog = self.prog()
+            if prog is None:
+                raise RuntimeError('Shader was freed')
+            
+            # Values are read column major
+            getter, esize = GETTERS[c_type], sizeof(c_type)*bcount
+            src = (c_type*length)()
+            address = addressof(src)
+            for i, element_loc in enumerate(self.element_locations(name)):
+                getter(prog.pid, element_loc, cast(address+i*esize, POINTER(c_type)))
+            row_major = False
+            
+        src = memoryview(src).cast('B').cast(c_type._type_)
+        if len(mat_size) == 1 and row_major != TRANSPOSE_MATRIX:
+            transpose_matrices_into(dst, src, mat_size[0], row_major)
+        else:
+            dst[:] = src
+            
+        return out
+        
+    def set_range(self, name, start, values):
+        """
+            Set the elements of an uniform array starting at the element "start". Only the modified elements are sent,
+            starting at the location of the first one (see element_locations).
+            
+            In deferred mode, the modified elements are saved and the ranges of an array are merged, so flush
+            sends them with the fewest calls.
+            
+            Arguments:
+                name: Name of the uniform
+                start: Index of the first element
+                values: Sequence of elements or object supporting the buffer protocol (see uniform_elements)
+        """
+        info = self.cache.get(name)
+        if info is None:
+            raise AttributeError('No uniform named "{}" found'.format(name))
+        if info.type not in UNIFORMS_DATA:
+            raise TypeError('Uniform type {} is not supported'.format(info.type))
+            
+        prog = self.prog()
+        if prog is None:
+            raise RuntimeError('Shader was freed')
+            
+        data, count = uniform_elements(values, info.type)
+        if count == 0:
+            return
+        if start < 0 or start >= info.size:
+            raise IndexError('Element index out of range')
+        if start+count > info.size:
+            raise IndexError('Too many values for uniform')
+            
+        c_type, bcount, *_ = UNIFORMS_DATA[info.type]
+        key, esize = info.loc.value, sizeof(c_type)*bcount
+        
+        if not self._deferred:
+            write = self.writer(name)
+            write(self.element_locations(name)[start], count, cast(data, POINTER(c_type)))
+            self._stats.issued += 1
+            self.update_shadow(info, addressof(data), start, count)
+            return
+            
+        # Pending write of the whole array
+        pending = self._dirty.get(key)
+        ranges = self._ranges.get(key)
+        if pending is not None and (ranges is None or ranges[0] is not pending):
+            memmove(addressof(pending[1])+start*esize, data, count*esize)
+            return
+            
+        if pending is None:
+            staged = self.read(name, shadow=True)
+            pending = (partial(self.upload_range, name, staged), staged)
+            ranges = self._ranges[key] = (pending, set())
+            self._dirty[key] = pending
+            
+        memmove(addressof(pending[1])+start*esize, data, count*esize)
+        ranges[1].update(range(start, start+count))
+        
+    def upload_range(self, name, staged):
+        """
+            Send the dirty elements of an array saved by set_range in deferred mode.
+            Consecutive elements are sent with a single call. Called by flush.
+        """
+        info = self.cache[name]
+        key = info.loc.value
+        pending, elements = self._ranges[key]
+        
+        c_type, bcount, *_ = UNIFORMS_DATA[info.type]
+        write = self.writer(name)
+        locations = self.element_locations(name)
+        address, esize = addressof(staged), sizeof(c_type)*bcount
+        
+        indices = sorted(elements)
+        runs, first = [], indices[0]
+        for previous, index in zip(indices, indices[1:]):
+            if index != previous+1:
+                runs.append((first, previous+1-first))
+                first = index
+        runs.append((first, indices[-1]+1-first))
+        
+        for first, count in runs:
+            write(locations[first], count, cast(address+first*esize, POINTER(c_type)))
+            self._stats.issued += 1
+            self.update_shadow(info, address+first*esize, first, count)
+            
+        del self._ranges[key]
+        
+    def update_shadow(self, info, address, start, count):
+        " Copy elements written by set_range in the last value sent to an uniform (see shadow) "
+        entry = self._shadow.get(info.loc.value)
+        if entry is None:
+            return
+            
+        c_type, bcount, setter, *mat_size = UNIFORMS_DATA[info.type]
+        if len(mat_size) == 1 and entry[0] != TRANSPOSE_MATRIX:
+            del self._shadow[info.loc.value]
+        else:
+            esize = sizeof(c_type)*bcount
+            memmove(addressof(entry[1])+start*esize, address, count*esize)
+            
+    def defer(self, enabled=True):
+        """
+            Enable or disable the deferred mode. In deferred mode, setting an uniform only saves its value and marks it as dirty.
+            The final values of the dirty uniforms are sent when the program is used or when flush is called.
+            Getting an uniform always returns the value in OpenGL, so call flush before reading a dirty uniform.
+            
+            The pending values are flushed when the deferred mode is disabled.
+        """
+        enabled = bool(enabled)
+        if enabled == self._deferred:
+            return
+            
+        if not enabled:
+            self.flush()
+        
+        self._deferred = enabled
+        self.rebuild()
+        
+    def flush(self):
+        """
+            Send the values of the dirty uniforms. The program must be in use, unless the setters
+            write the uniforms directly (see direct_uniforms). Called by ShaderProgram.use.
+        """
+        dirty = self._dirty
+        while dirty:
+            key, pending = dirty.popitem()
+            try:
+                pending[0]()
+            except Exception:
+                dirty[key] = pending
+                raise
+        
+    def invalidate(self):
+        """
+            Forget the last values sent to the uniforms. The next writes will always reach OpenGL.
+            This is done when the shader is linked. Call this manually if the uniforms
+            were modified outside the api (ex: by calling glUniform directly).
+        """
+        self._shadow.clear()
+        
+    def set_many(self, names, values, sort=False):
+        """
+            Set many uniforms at once. The names are all resolved before the first
+            value is sent, so an unknown name does not leave the batch half applied.
+            
+            Arguments:
+                names: Sequence of uniform names
+                values: Sequence of values, in the same order as names
+                sort: If True, the values are sent in the order of the uniform locations
+        """
+        cache = self.cache
+        try:
+            infos = [cache[name] for name in names]
+        except KeyError as e:
+            raise AttributeError('No uniform named "{}" found'.format(e.args[0])) from None
+            
+        if sort:
+            calls = sorted(zip(infos, values), key=lambda c: c[0].loc.value)
+        else:
+            calls = zip(infos, values)
+            
+        for info, value in calls:
+            info.set(value)
+            
+    def update(self, values, sort=False):
+        """
+            Set many uniforms from a mapping of names to values (or an iterable of (name, value) pairs).
+            See set_many.
+        """
+        if isinstance(values, Mapping):
+            self.set_many(values.keys(), values.values(), sort)
+        else:
+            values = tuple(values)
+            self.set_many([v[0] for v in values], [v[1] for v in values], sort)
+        
+    def __getattr__(self, name):
+        if name in ('cache', '_resources'):
+            return self.reflect(name)
+        
+        if name in self.cache.keys():
+            prog = self.prog()
+            if prog is None:
+                raise RuntimeError('Shader was freed')
+            return self.cache.get(name).get(prog.pid)
+        elif name in self._structs.keys():
+            return self._structs[name].get()
+                
+        raise AttributeError('No uniform named "{}" found'.format(name))
         
     def __setattr__(self, name, value):
-        if name in ShaderAccessor.__slots__:
+        if name in ShaderAccessor.__slots__ or name in ShaderUniformAccessor.__slots__:
             return object.__setattr__(self, name, value)
         elif name in self.cache.keys():
             return self.cache.get(name).set(value)
+        elif name in self._structs.keys():
+            return self._structs[name].set(value)
         
         raise AttributeError('No attribute/uniform named "{}" found'.format(name))
 
@@ -665,11 +1805,13 @@ class ShaderProgram(object):
             Attach shader objects to the program. 
             Objs must be a list of ShaderObject. 
             
-            Ownership of the underlying shaders is transferred to the program .
+            Ownership of the underlying shaders is transferred to the program,
+            unless the shaders belong to a ShaderObjectPool.
         """
         for obj in objs:
             glAttachShader(self.pid, obj.sid)
-            obj.owned = False
+            if not obj.pooled:
+                obj.owned = False
             
     def detach(self, *objs, delete=True):
         """
@@ -677,11 +1819,13 @@ class ShaderProgram(object):
             Objs must be a list of ShaderObject.
             
             Keyword argument:
-                delete: If the detached shaders should be marked for destruction
+                delete: If the detached shaders should be marked for destruction.
+                        Shaders that belong to a ShaderObjectPool are never marked.
         """
         for obj in objs:
             glDetachShader(self.pid, obj.sid)
-            obj.owned = delete
+            if not obj.pooled:
+                obj.owned = delete
         
     def valid(self):
         """
@@ -698,9 +1842,47 @@ class ShaderProgram(object):
         """
         glLinkProgram(self.pid)
         if self.link_status == GL_TRUE:
+            self.reload()
+            return True
+            
+    def reload(self):
+        """
+            Reload the uniforms and attributes caches. This is done by link.
+            If the shader was linked outside the api, you have to call this manually.
+            
+            In lazy mode (see lazy_reflection), the caches are reloaded the first time they are used.
+        """
+        if LAZY_REFLECTION:
+            self.uniforms.reset()
+            self.attributes.reset()
+        else:
             self.uniforms.reload()
             self.attributes.reload()
-            return True
+        
+    def reflection(self):
+        """
+            Return the reflection metadata of the program: the (name, type, size, location) of
+            its uniforms and attributes, in a dict that can be serialized with json.
+            See restore_reflection.
+        """
+        return {'uniforms': [list(r) for r in self.uniforms._resources],
+                'attributes': [list(r) for r in self.attributes._resources]}
+                
+    def restore_reflection(self, reflection, verify=None):
+        """
+            Rebuild the uniforms and attributes caches from metadata returned by reflection, without querying the program.
+            The metadata must come from a program linked from the same sources by the same driver (see source_hash and driver_identity).
+            
+            Arguments:
+                reflection: Reflection metadata
+                verify: If True, the metadata is compared with the reflection of the program and a ValueError
+                        is raised if they differ. Defaults to VERIFY_REFLECTION (see verify_reflection).
+        """
+        if verify is None:
+            verify = VERIFY_REFLECTION
+            
+        self.uniforms.reload(reflection['uniforms'], verify)
+        self.attributes.reload(reflection['attributes'], verify)
         
     def shaders(self):
         """
@@ -708,11 +1890,16 @@ class ShaderProgram(object):
             The returned shader objects do not own the underlying shader.
         """
         shaders = read_opengl_array(self.pid, self.shaders_count, glGetAttachedShaders, c_uint)  
-        return [ShaderObject(sid) for sid in shaders]
+        objs = [ShaderObject(sid) for sid in shaders]
+        for obj in objs:
+            obj.pooled = obj.sid.value in POOLED_SHADERS
+        return objs
         
     def use(self):
-        " Use the shader program "
+        " Use the shader program and send the deferred uniforms values "
         glUseProgram(self.pid)
+        if self.uniforms._dirty:
+            self.uniforms.flush()
         
         
     def enable_all_attributes(self):
@@ -776,7 +1963,7 @@ def current_program():
     else:
         return ShaderProgram(cprog)
 
-def from_string(verts, frags):
+def from_string(verts, frags, cache=None, pool=None, trusted=None):
     """
         High level loading function.
         
@@ -786,38 +1973,79 @@ def from_string(verts, frags):
 
         verts: Sequence of vertex shader sources
         frags: Sequence of fragment shader sources
+               A source can also be a sequence of strings compiled in the same shader
+               object (ex: a preamble and a body).
+        cache: Optional program cache (ex: a ProgramBinaryCache from the program_binary extension).
+               The cache must implement load(verts, frags), prepare(prog) and store(verts, frags, prog)
+        pool: Optional ShaderObjectPool. Compiled shader objects are taken from the pool and shared between programs.
+        trusted: If True, only the link status is queried. The shader objects status and logs are only
+                 queried if the link fails. Default to the value set with trust_shaders.
+                 Ignored when a pool is used.
     """
     if isinstance(verts, str): verts = (verts,)
     if isinstance(frags, str): frags = (frags,)
+    
+    if cache is not None:
+        prog = cache.load(verts, frags)
+        if prog is not None:
+            return prog
+        
+    if trusted is None:
+        trusted = TRUSTED_SHADERS
+        
+    if trusted and pool is None:
+        pending = PendingProgram(verts, frags)
+        pending.compile()
+        pending.link(cache)
+        prog = pending.result()
+        
+        if cache is not None:
+            cache.store(verts, frags, prog)
+            
+        return prog
         
     logs, objs = "", []
     
-    for src in verts:
-        vert = ShaderObject.vertex()
-        vert.source = src
-        objs.append(vert)
-    
-    for src in frags:
-        frag = ShaderObject.fragment()
-        frag.source = src       
-        objs.append(frag)
-        
-    for obj in objs:
-        if obj.compile() is False:
-            logs += obj.logs
+    if pool is not None:
+        for shader_type, srcs in ((GL_VERTEX_SHADER, verts), (GL_FRAGMENT_SHADER, frags)):
+            for src in srcs:
+                try:
+                    objs.append(pool.get(shader_type, src))
+                except ShaderCompilationError as e:
+                    logs += e.logs
+    else:
+        for src in verts:
+            vert = ShaderObject.vertex()
+            vert.source = src
+            objs.append(vert)
+        
+        for src in frags:
+            frag = ShaderObject.fragment()
+            frag.source = src       
+            objs.append(frag)
+            
+        for obj in objs:
+            if obj.compile() is False:
+                logs += obj.logs
     
     if len(logs) == 0:
         prog = ShaderProgram.new_program()
+        if cache is not None:
+            cache.prepare(prog)
+            
         prog.attach(*objs)
         if not prog.link():
             raise ShaderCompilationError(prog.logs)
+        
+        if cache is not None:
+            cache.store(verts, frags, prog)
             
         return prog
     
     raise ShaderCompilationError(logs)
         
 
-def from_files_names(verts, frags):
+def from_files_names(verts, frags, preprocessor=None, **kwargs):
     """
         High level loading function.
         
@@ -827,21 +2055,34 @@ def from_files_names(verts, frags):
         
         verts: Sequence of file names pointing to vertex shader source file
         frags: Sequence of file names pointing to fragment shader source file
+        preprocessor: Optional ShaderPreprocessor used to resolve the includes. The files 
+                      paths are added to the compilation logs.
+        
+        Other keyword arguments are forwarded to from_string.
     """
     if isinstance(verts, str): verts = (verts,)
     if isinstance(frags, str): frags = (frags,)
+    
+    if preprocessor is not None:
+        try:
+            return from_string([preprocessor.preprocess(fname) for fname in verts],
+                               [preprocessor.preprocess(fname) for fname in frags], **kwargs)
+        except ShaderCompilationError as e:
+            e.logs += preprocessor.legend()
+            raise
         
     verts_files = [open(fname, 'r') for fname in verts]
     frags_files = [open(fname, 'r') for fname in frags]
     
-    shader = from_files(verts_files, frags_files)
-    
-    for f in verts_files + frags_files:
-        f.close()
+    try:
+        shader = from_files(verts_files, frags_files, **kwargs)
+    finally:
+        for f in verts_files + frags_files:
+            f.close()
         
     return shader
 
-def from_files(verts, frags):
+def from_files(verts, frags, **kwargs):
     """
         High level loading function.
         
@@ -855,6 +2096,8 @@ def from_files(verts, frags):
         
         verts: Sequence of files pointing to vertex shader source file
         frags: Sequence of files pointing to a fragment shader source file
+        
+        Other keyword arguments are forwarded to from_string.
     """
     if not isinstance(verts, Sequence): verts = (verts,)
     if not isinstance(frags, Sequence): frags = (frags,)
@@ -862,7 +2105,827 @@ def from_files(verts, frags):
     vert_srcs = [vert.read() for vert in verts]
     frag_srcs = [frag.read() for frag in frags]
     
-    return from_string(vert_srcs, frag_srcs)
+    return from_string(vert_srcs, frag_srcs, **kwargs)
+        
+def build_async(verts, frags):
+    """
+        High level loading function.
+        
+        Start building a program from sources without waiting for the driver.
+        Return a PendingProgram: "done" tells if the build is finished and "result"
+        return the linked program or raise a ShaderCompilationError.
+        
+        The driver only compiles in the background if the parallel_shader_compile
+        extension is loaded. Otherwise, "done" always return True and "result" waits
+        for the driver like from_string.
+        
+        verts: Sequence of vertex shader sources
+        frags: Sequence of fragment shader sources
+    """
+    pending = PendingProgram(verts, frags)
+    pending.compile()
+    pending.link()
+    return pending
+
+
+class PendingProgram(object):
+    """
+        A program being built. Compile and link only send the commands to the driver,
+        the compilation and link status are not queried until "result" is called.
+        
+        Slots:
+            objects: Shader objects of the program
+            program: The program. None until link is called.
+            error: The ShaderCompilationError raised by result, if any
+            ready: If the program caches were built
+    """
+    
+    __slots__ = ['objects', 'program', 'error', 'ready']
+    
+    def __init__(self, verts, frags):
+        if isinstance(verts, str): verts = (verts,)
+        if isinstance(frags, str): frags = (frags,)
+        
+        self.objects = []
+        self.program = None
+        self.error = None
+        self.ready = False
+        
+        for src in verts:
+            vert = ShaderObject.vertex()
+            vert.source = src
+            self.objects.append(vert)
+            
+        for src in frags:
+            frag = ShaderObject.fragment()
+            frag.source = src
+            self.objects.append(frag)
+            
+    def compile(self):
+        " Send the compile commands of the shader objects "
+        for obj in self.objects:
+            glCompileShader(obj.sid)
+            
+    def link(self, cache=None):
+        """
+            Attach the shader objects to a new program and send the link command
+            
+            cache: Optional program cache. cache.prepare is called before the link.
+        """
+        self.program = ShaderProgram.new_program()
+        if cache is not None:
+            cache.prepare(self.program)
+            
+        self.program.attach(*self.objects)
+        glLinkProgram(self.program.pid)
+        
+    def done(self):
+        """
+            Return True if the driver finished building the program. Never wait.
+            Always return True if the parallel_shader_compile extension is not loaded.
+        """
+        if not PARALLEL_COMPILE or self.ready or self.error is not None:
+            return True
+        
+        return self.program.completion_status == GL_TRUE
+        
+    def result(self):
+        """
+            Wait until the program is built and return it. 
+            Raise a ShaderCompilationError if the compilation or the linking failed.
+        """
+        if self.error is not None:
+            raise self.error
+        
+        prog = self.program
+        if not self.ready:
+            if prog.link_status != GL_TRUE:
+                # Find out which stage failed only when the link failed
+                logs = "".join(obj.logs for obj in self.objects if obj.compiled != GL_TRUE)
+                self.error = ShaderCompilationError(logs if len(logs) > 0 else prog.logs)
+                raise self.error
+            
+            prog.reload()
+            self.ready = True
+            
+        return prog
+        
+        
+class ProgramBatch(object):
+    """
+        Build many programs at once. Every shader object is compiled, then every
+        program is linked and the status are only queried at the end. This way the 
+        driver is not stalled between each program.
+        
+        Slots:
+            pending: PendingProgram of every program in the batch
+    """
+    
+    __slots__ = ['pending']
+    
+    def __init__(self, specs=()):
+        """
+            Create a new batch.
+            
+            specs: Sequence of (verts, frags) to add to the batch
+        """
+        self.pending = []
+        for verts, frags in specs:
+            self.add(verts, frags)
+        
+    def add(self, verts, frags):
+        """
+            Add a program to the batch. Return the index of the program in the 
+            list returned by build.
+            
+            verts: Sequence of vertex shader sources
+            frags: Sequence of fragment shader sources
+        """
+        self.pending.append(PendingProgram(verts, frags))
+        return len(self.pending)-1
+        
+    def build(self):
+        """
+            Build every program of the batch. Return a list with, for each program,
+            the linked ShaderProgram or the ShaderCompilationError raised while building it.
+        """
+        for pending in self.pending:
+            pending.compile()
+            
+        for pending in self.pending:
+            pending.link()
+        
+        results = []
+        for pending in self.pending:
+            try:
+                results.append(pending.result())
+            except ShaderCompilationError as e:
+                results.append(e)
+        
+        return results
+        
+    def __len__(self):
+        return len(self.pending)
+        
+        
+def read_source(fname):
+    " Return the content of a shader source file "
+    with open(fname, 'r') as f:
+        return f.read()
+
+
+class ShaderPreprocessor(object):
+    """
+        Resolve the '#include "file"' directives of shader source files.
+        
+        Included files are searched relatively to the including file, then in the search paths.
+        Parsed files are cached by path and modification time with the include graph, so
+        preprocessing a file again only rereads the files that changed. '#version' directives
+        in included files are removed and '#pragma once' is supported.
+        
+        '#line' directives are emitted around included files so the line numbers in the 
+        compilation logs stay correct. The source string number of the directives is the 
+        index of the file in "files".
+        
+        Slots:
+            search_paths: Directories where the included files are searched
+            files: Preprocessed files paths. The index of a path is its source string number.
+            parsed: Parsed files by path, as (mtime, lines, includes). 
+                    includes maps a line index to the path of the included file.
+            reads: Number of files read from the disk
+            lock: Lock that allow the preprocessor to be used from many threads
+    """
+    
+    __slots__ = ['search_paths', 'files', 'parsed', 'reads', 'lock']
+    
+    include_re = re.compile(r'^\s*#\s*include\s+["<]([^">]+)[">]')
+    version_re = re.compile(r'^\s*#\s*version\s+(\d+)')
+    pragma_once_re = re.compile(r'^\s*#\s*pragma\s+once\b')
+    
+    def __init__(self, search_paths=()):
+        self.search_paths = list(search_paths)
+        self.files = []
+        self.parsed = {}
+        self.reads = 0
+        self.lock = threading.RLock()
+        
+    def file_index(self, path):
+        " Return the source string number of a file "
+        try:
+            return self.files.index(path)
+        except ValueError:
+            self.files.append(path)
+            return len(self.files)-1
+            
+    def file_name(self, index):
+        " Return the path of a file from its source string number "
+        return self.files[index]
+        
+    def resolve(self, name, parent):
+        " Return the path of an included file. Used internally. "
+        for directory in [os.path.dirname(parent)] + self.search_paths:
+            path = os.path.abspath(os.path.join(directory, name))
+            if os.path.isfile(path):
+                return path
+                
+        raise ShaderCompilationError('{}: Cannot find included file "{}"\n'.format(parent, name))
+        
+    def parse(self, path):
+        """
+            Return the parsed file as (mtime, lines, includes). The file is only read
+            if it changed since it was last parsed.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.parsed.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached
+        
+        with open(path, 'r') as f:
+            lines = f.read().split('\n')
+        self.reads += 1
+        
+        includes = {}
+        for i, line in enumerate(lines):
+            match = self.include_re.match(line)
+            if match is not None:
+                includes[i] = self.resolve(match.group(1), path)
+        
+        parsed = self.parsed[path] = (mtime, lines, includes)
+        return parsed
+        
+    def dependencies(self, path):
+        " Return the paths of every file included by a file, directly or not "
+        path = os.path.abspath(path)
+        with self.lock:
+            deps, stack = set(), [path]
+            while len(stack) > 0:
+                for include in self.parse(stack.pop())[2].values():
+                    if include not in deps:
+                        deps.add(include)
+                        stack.append(include)
+            return deps
+    
+    def preprocess(self, path):
+        " Return the preprocessed source of a file "
+        path = os.path.abspath(path)
+        with self.lock:
+            out, included = [], set()
+            self.expand(path, out, included, [], None)
+            return '\n'.join(out)
+        
+    def expand(self, path, out, included, stack, line_offset):
+        " Write the preprocessed lines of a file in out. Used internally. "
+        if path in stack:
+            raise ShaderCompilationError('{}: Recursive include of "{}"\n'.format(stack[-1], path))
+            
+        mtime, lines, includes = self.parse(path)
+        index = self.file_index(path)
+        root = line_offset is None
+        
+        if root:
+            # GLSL < 3.30 sets the line number of the line following the directive to line+1
+            match = next(filter(None, map(self.version_re.match, lines)), None)
+            line_offset = 0 if match is not None and int(match.group(1)) >= 330 else -1
+            if match is None:
+                out.append('#line {} {}'.format(1+line_offset, index))
+        
+        stack.append(path)
+        for i, line in enumerate(lines):
+            include = includes.get(i)
+            if include is not None:
+                if not include in included:
+                    out.append('#line {} {}'.format(1+line_offset, self.file_index(include)))
+                    self.expand(include, out, included, stack, line_offset)
+                out.append('#line {} {}'.format(i+2+line_offset, index))
+            elif self.version_re.match(line) is not None:
+                if root:
+                    out.append(line)
+                    out.append('#line {} {}'.format(i+2+line_offset, index))
+                else:
+                    out.append('')
+            elif self.pragma_once_re.match(line) is not None:
+                included.add(path)
+                out.append('')
+            else:
+                out.append(line)
+        stack.pop()
+        
+    def legend(self):
+        " Return a text that maps the source string numbers to the files paths "
+        return 'Source strings:\n' + ''.join('  {}: {}\n'.format(i, path) for i, path in enumerate(self.files))
+        
+        
+class GLScheduler(object):
+    """
+        Queue of opengl work that must run on the thread that owns the opengl context.
+        Any thread can submit work, the work is done when the context thread calls
+        pump (ex: once per frame). Submitting returns a concurrent.futures.Future.
+        
+        Slots:
+            calls: Calls waiting to be run, as (fn, args, future)
+            builds: Programs waiting for the driver, as (PendingProgram, future)
+    """
+    
+    __slots__ = ['calls', 'builds']
+    
+    def __init__(self):
+        self.calls = deque()
+        self.builds = []
+        
+    def call(self, fn, *args):
+        " Run fn(*args) on the context thread. Return a future of the result. "
+        future = Future()
+        self.calls.append((fn, args, future))
+        return future
+        
+    def build(self, verts, frags):
+        """
+            Build a program on the context thread using build_async. 
+            Return a future of the linked program. The future is resolved by the 
+            first call to pump after the driver is done.
+        """
+        return self.call(build_async, verts, frags)
+        
+    def pump(self, max_calls=None):
+        """
+            Run the queued calls and resolve the finished builds. Must be called 
+            by the thread that owns the opengl context. Return the number of calls run.
+            
+            max_calls: Maximum number of calls to run. Use it to limit the time spent per frame.
+        """
+        count = 0
+        while len(self.calls) > 0 and (max_calls is None or count < max_calls):
+            fn, args, future = self.calls.popleft()
+            count += 1
+            if not future.set_running_or_notify_cancel():
+                continue
+            
+            try:
+                result = fn(*args)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+                
+            if isinstance(result, PendingProgram):
+                self.builds.append((result, future))    # Resolved once the driver is done
+            else:
+                future.set_result(result)
+            
+        builds, self.builds = self.builds, []
+        for pending, future in builds:
+            if not pending.done():
+                self.builds.append((pending, future))
+                continue
+                
+            try:
+                future.set_result(pending.result())
+            except ShaderCompilationError as e:
+                future.set_exception(e)
+                
+        return count
+        
+    def __len__(self):
+        " Return the number of calls and builds waiting "
+        return len(self.calls) + len(self.builds)
+        
+        
+async def from_files_names_async(verts, frags, scheduler, read=read_source, executor=None):
+    """
+        High level loading function. Coroutine.
+        
+        Read the files in an executor, then build the program on the context thread
+        through a GLScheduler. Return a linked shaderprogram. The shaderprogram owns the gl resource.
+        
+        verts: Sequence of file names pointing to vertex shader source file
+        frags: Sequence of file names pointing to fragment shader source file
+        scheduler: GLScheduler pumped by the thread that owns the opengl context
+        read: Function called in the executor with a file name that returns a shader source.
+              Can be used to preprocess the sources.
+        executor: Executor used to read the files. Default to the loop default executor.
+    """
+    if isinstance(verts, str): verts = (verts,)
+    if isinstance(frags, str): frags = (frags,)
+    
+    loop = asyncio.get_running_loop()
+    srcs = await asyncio.gather(*[loop.run_in_executor(executor, read, fname) 
+                                  for fname in tuple(verts)+tuple(frags)])
+    
+    future = scheduler.build(srcs[0:len(verts)], srcs[len(verts):])
+    return await asyncio.wrap_future(future)
+    
+    
+class ShaderObjectPool(object):
+    """
+        Pool of compiled shader objects keyed by shader type and source hash.
+        The same compiled object is attached to every program that uses the same source,
+        so shared stages (ex: a library of functions) are only compiled once.
+        
+        The pool owns its shader objects: programs do not take their ownership 
+        when they are attached and do not delete them when they are freed.
+        The objects are marked for deletion when they are removed from the pool.
+        
+        Slots:
+            objects: Compiled shader objects by (shader type, source hash)
+            compiled: Number of shader objects compiled by the pool
+    """
+    
+    __slots__ = ['objects', 'compiled']
+    
+    def __init__(self):
+        self.objects = {}
+        self.compiled = 0
+        
+    def get(self, shader_type, src):
+        """
+            Return a compiled shader object. If the source was not compiled before,
+            a new shader object is compiled and added to the pool.
+            Raise a ShaderCompilationError if the compilation fails.
+            
+            shader_type: Type of the shader (ex: GL_VERTEX_SHADER)
+            src: Source of the shader. A string or a sequence of strings.
+        """
+        key = (shader_type, source_hash((src,), ()))
+        obj = self.objects.get(key)
+        if obj is not None:
+            return obj
+        
+        obj = ShaderObject.new_shader(shader_type)
+        obj.source = src
+        self.compiled += 1
+        if obj.compile() is False:
+            raise ShaderCompilationError(obj.logs)
+        
+        obj.pooled = True
+        POOLED_SHADERS[obj.sid.value] = obj
+        self.objects[key] = obj
+        return obj
+        
+    def remove(self, obj):
+        """
+            Remove a shader object from the pool. The shader is marked for deletion, 
+            opengl frees it once it is detached from every program.
+        """
+        for key, pooled in self.objects.items():
+            if pooled == obj:
+                del self.objects[key]
+                self.release(pooled)
+                return
+            
+        raise ValueError('{} is not in the pool'.format(obj))
+        
+    def clear(self):
+        " Remove every shader object from the pool "
+        for obj in self.objects.values():
+            self.release(obj)
+        self.objects.clear()
+        
+    @staticmethod
+    def release(obj):
+        " Give back the ownership of a shader object removed from the pool "
+        obj.pooled = False
+        if POOLED_SHADERS.get(obj.sid.value) is obj:
+            del POOLED_SHADERS[obj.sid.value]
+            
+    def __del__(self):
+        self.clear()
+        
+    def __len__(self):
+        return len(self.objects)
+        
+    def __contains__(self, obj):
+        return obj in self.objects.values()
+        
+class ProgramCache(object):
+    """
+        In-process cache of linked programs. Programs built from identical sources 
+        are shared between their users and are freed when their last user releases them.
+        
+        If max_idle is set, up to max_idle released programs are kept alive so they
+        can be reused. The least recently released programs are freed first.
+        
+        Slots:
+            entries: Cached programs by sources hash. Values are [program, refcount]
+            keys: Sources hash by program id
+            idle: Sources hash of the released programs that are kept alive, least recently used first
+            max_idle: Maximum number of released programs kept alive. None means that programs are freed immediately
+            cache: Program cache forwarded to from_string when a program is built (ex: a ProgramBinaryCache)
+    """
+    
+    __slots__ = ['entries', 'keys', 'idle', 'max_idle', 'cache']
+    
+    def __init__(self, max_idle=None, cache=None):
+        self.entries = {}
+        self.keys = {}
+        self.idle = OrderedDict()
+        self.max_idle = max_idle
+        self.cache = cache
+        
+    def acquire(self, verts, frags):
+        """
+            Return a linked program built from the sources. If the sources were 
+            already built, the existing program is returned.
+            Every call must be matched with a call to release.
+            
+            verts: Sequence of vertex shader sources
+            frags: Sequence of fragment shader sources
+        """
+        key = source_hash(verts, frags)
+        entry = self.entries.get(key)
+        if entry is None:
+            prog = from_string(verts, frags, cache=self.cache)
+            entry = self.entries[key] = [prog, 0]
+            self.keys[prog.pid.value] = key
+        else:
+            self.idle.pop(key, None)
+            
+        entry[1] += 1
+        return entry[0]
+        
+    def release(self, prog):
+        """
+            Release a program returned by acquire. The program is freed when
+            it is released by its last user, unless it is kept alive by max_idle.
+        """
+        key = self.keys.get(prog.pid.value)
+        if key is None:
+            raise ValueError('{} is not in the cache'.format(prog))
+            
+        entry = self.entries[key]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        
+        if self.max_idle:
+            self.idle[key] = None
+            while len(self.idle) > self.max_idle:
+                self.remove(self.idle.popitem(last=False)[0])
+        else:
+            self.remove(key)
+            
+    def refcount(self, prog):
+        " Return the number of users of a program. Return 0 if the program is not in the cache. "
+        key = self.keys.get(prog.pid.value)
+        return 0 if key is None else self.entries[key][1]
+            
+    def remove(self, key):
+        " Remove a program from the cache. Used internally. "
+        prog, count = self.entries.pop(key)
+        del self.keys[prog.pid.value]
+        
+    def clear(self):
+        " Remove every idle program. Programs still in use are kept. "
+        for key in self.idle:
+            self.remove(key)
+        self.idle.clear()
+        
+    def __len__(self):
+        " Return the number of programs in the cache, idle programs included "
+        return len(self.entries)
+        
+    def __contains__(self, prog):
+        return isinstance(prog, ShaderProgram) and prog.pid.value in self.keys
+        
+class ShaderWatcher(object):
+    """
+        Watch the source files of programs and rebuild the programs when the files change.
+        
+        The files modification times are polled by a background thread (see start). 
+        The programs are rebuilt by update, which must be called by the thread that owns 
+        the opengl context (ex: once per frame).
+        
+        Only the shader objects of the files that changed (or of the files including them)
+        are compiled again, and only the programs using them are linked again. The programs 
+        keep their python object, and the values of their uniforms are restored after the link.
+        If a compilation or a link fails, the previous program is kept and the error
+        is saved in "errors". Files that cannot be read or that include a missing file
+        are checked again by the next update.
+        
+        Slots:
+            preprocessor: ShaderPreprocessor used to read the files
+            pool: ShaderObjectPool holding the compiled shader objects
+            interval: Polling interval of the background thread in seconds
+            stages: Last compiled shader object by (shader type, path)
+            programs: Watched programs as [weakref to the program, stages keys, shader objects]
+            mtimes: Modification time of the watched files by path
+            changed: Files that changed since the last update
+            errors: ShaderCompilationError and OSError raised during the last update
+            lock: Lock protecting mtimes and changed
+            thread: Background polling thread
+            stopped: Event used to stop the background thread
+    """
+    
+    __slots__ = ['preprocessor', 'pool', 'interval', 'stages', 'programs', 'mtimes',
+                 'changed', 'errors', 'lock', 'thread', 'stopped']
+    
+    def __init__(self, preprocessor=None, interval=0.5):
+        self.preprocessor = preprocessor if preprocessor is not None else ShaderPreprocessor()
+        self.pool = ShaderObjectPool()
+        self.interval = interval
+        self.stages = {}
+        self.programs = []
+        self.mtimes = {}
+        self.changed = set()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        
+    def load(self, verts, frags):
+        """
+            Build a program from files and watch the files.
+            Return a linked shaderprogram. The shaderprogram owns the gl resource.
+            
+            verts: Sequence of file names pointing to vertex shader source file
+            frags: Sequence of file names pointing to fragment shader source file
+        """
+        if isinstance(verts, str): verts = (verts,)
+        if isinstance(frags, str): frags = (frags,)
+        
+        keys = [(GL_VERTEX_SHADER, os.path.abspath(f)) for f in verts]
+        keys += [(GL_FRAGMENT_SHADER, os.path.abspath(f)) for f in frags]
+        
+        logs, objs = "", []
+        for key in keys:
+            obj = self.stages.get(key)
+            if obj is None:
+                try:
+                    obj = self.compile(key)
+                except ShaderCompilationError as e:
+                    logs += e.logs
+                    continue
+            objs.append(obj)
+            
+        if len(logs) > 0:
+            raise ShaderCompilationError(logs + self.preprocessor.legend())
+            
+        prog = ShaderProgram.new_program()
+        prog.attach(*objs)
+        if not prog.link():
+            raise ShaderCompilationError(prog.logs)
+        
+        self.programs.append([weakref.ref(prog), keys, objs])
+        self.watch([key[1] for key in keys])
+        return prog
+        
+    def compile(self, key):
+        " Compile the shader object of a (shader type, path) key. Used internally. "
+        shader_type, path = key
+        obj = self.pool.get(shader_type, self.preprocessor.preprocess(path))
+        self.stages[key] = obj
+        return obj
+        
+    def watch(self, paths):
+        " Add files and their includes to the watched files. Used internally. "
+        for path in paths:
+            for fname in [path] + list(self.preprocessor.dependencies(path)):
+                if fname not in self.mtimes:
+                    with self.lock:
+                        self.mtimes[fname] = os.stat(fname).st_mtime_ns
+                
+    def poll(self):
+        " Check the modification time of the watched files. Called by the background thread. "
+        with self.lock:
+            paths = list(self.mtimes.keys())
+            
+        for path in paths:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue     # The file may be in the middle of being saved
+                
+            with self.lock:
+                if self.mtimes.get(path) != mtime:
+                    self.mtimes[path] = mtime
+                    self.changed.add(path)
+                    
+    def start(self):
+        " Start polling the files in a background thread. The thread runs until stop is called. "
+        if self.thread is not None:
+            return
+            
+        def run():
+            while not self.stopped.wait(self.interval):
+                self.poll()
+            
+        self.stopped.clear()
+        self.thread = threading.Thread(target=run, name='ShaderWatcher', daemon=True)
+        self.thread.start()
+        
+    def stop(self):
+        " Stop the background thread "
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        
+    def update(self):
+        """
+            Rebuild the programs that use the files that changed. Must be called by the 
+            thread that owns the opengl context. Return the list of programs rebuilt.
+        """
+        with self.lock:
+            changed, self.changed = self.changed, set()
+            
+        if len(changed) == 0:
+            return []
+        
+        self.errors = []
+        failed = set()
+        replaced = {}
+        for key, obj in list(self.stages.items()):
+            try:
+                deps = self.preprocessor.dependencies(key[1])
+            except (ShaderCompilationError, OSError) as e:
+                self.errors.append(e)
+                failed.add(key[1])      # Ex: an included file does not exist yet
+                continue
+                
+            if key[1] not in changed and len(deps & changed) == 0:
+                continue
+                
+            try:
+                new_obj = self.compile(key)
+            except ShaderCompilationError as e:
+                e.logs += self.preprocessor.legend()
+                self.errors.append(e)
+                continue
+            except OSError as e:
+                self.errors.append(e)
+                failed.add(key[1])
+                continue
+            
+            if new_obj != obj:
+                replaced[key] = new_obj
+        
+        rebuilt = []
+        for entry in self.programs:
+            prog, keys, objs = entry[0](), entry[1], entry[2]
+            if prog is None or not any(key in replaced for key in keys):
+                continue
+            
+            new_objs = [replaced.get(key, obj) for key, obj in zip(keys, objs)]
+            try:
+                self.relink(prog, new_objs)
+            except ShaderCompilationError as e:
+                self.errors.append(e)
+                continue
+                
+            entry[2] = new_objs
+            rebuilt.append(prog)
+            
+        self.watch({key[1] for key in self.stages} - failed)
+        self.collect()
+        
+        with self.lock:
+            self.changed.update(failed)
+            
+        return rebuilt
+        
+    def relink(self, prog, objs):
+        """
+            Link a new opengl program with the shader objects and swap it with the program.
+            The program is left untouched if the link fails. Used internally.
+        """
+        new = ShaderProgram.new_program()
+        new.attach(*objs)
+        if not new.link():
+            raise ShaderCompilationError(new.logs)
+        
+        if prog.uniforms._dirty:
+            with prog.using():      # The pending deferred values must reach the program before they are read
+                prog.uniforms.flush()
+        
+        values = [(name, info.get(prog.pid)) for name, info in prog.uniforms]
+        current = current_program()
+        
+        # The previous opengl program is freed with "new"
+        prog.pid, new.pid = new.pid, prog.pid
+        prog.reload()
+        
+        with prog.using():
+            for name, value in values:
+                if value is None or name not in prog.uniforms:
+                    continue
+                try:
+                    setattr(prog.uniforms, name, value)
+                except (TypeError, IndexError):
+                    pass        # The type of the uniform changed
+            prog.uniforms.flush()
+                    
+        if current is not None and current.pid.value == new.pid.value:
+            prog.use()
+            
+    def collect(self):
+        " Remove the shader objects that are not used anymore from the pool. Used internally. "
+        self.programs = [entry for entry in self.programs if entry[0]() is not None]
+        used = {obj.sid.value for obj in self.stages.values()}
+        for entry in self.programs:
+            used.update(obj.sid.value for obj in entry[2])
+            
+        for obj in list(self.pool.objects.values()):
+            if obj.sid.value not in used:
+                self.pool.remove(obj)
+        
         
 def extension_loaded(extension_name):
     """
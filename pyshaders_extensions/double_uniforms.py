@@ -54,27 +54,24 @@ def supported():
     return check_requirements(target_gl=(3,2), target_glsl=(1,50)) and gl_info.have_extension('GL_ARB_gpu_shader_fp64')
 
 def load(mod):
-    # Add getters
-    mod.GETTERS[GLdouble] = glGetUniformdv
+    # Add getters and buffer protocol format
+    mod.register_uniform_component(GLdouble, glGetUniformdv, 'd')
     
-    # To unpack array correctly
-    mod.UNPACK_ARRAY.append(GL_DOUBLE)
-    
-    # Add uniform data
+    # Add uniform data. Double matrices are always transposed
     uniform_data = {
         GL_DOUBLE: (GLdouble, 1, glUniform1dv),
         GL_DOUBLE_VEC2: (GLdouble, 2, glUniform2dv),
         GL_DOUBLE_VEC3: (GLdouble, 3, glUniform3dv),
         GL_DOUBLE_VEC4: (GLdouble, 4, glUniform4dv),
-        GL_DOUBLE_MAT2: (GLdouble, 4, lambda x,y,z: glUniformMatrix2dv(x,y,True,z),      (2,2)),
-        GL_DOUBLE_MAT3: (GLdouble, 9, lambda x,y,z: glUniformMatrix3dv(x,y,True,z),      (3,3)),
-        GL_DOUBLE_MAT4: (GLdouble, 16, lambda x,y,z: glUniformMatrix4dv(x,y,True,z),     (4,4)),
-        GL_DOUBLE_MAT2x3: (GLdouble, 6, lambda x,y,z: glUniformMatrix2x3dv(x,y,True,z),    (2,3)),
-        GL_DOUBLE_MAT2x4: (GLdouble, 8, lambda x,y,z: glUniformMatrix2x4dv(x,y,True,z),    (2,4)),
-        GL_DOUBLE_MAT3x2: (GLdouble, 6, lambda x,y,z: glUniformMatrix3x2dv(x,y,True,z),    (3,2)),
-        GL_DOUBLE_MAT3x4: (GLdouble, 12, lambda x,y,z: glUniformMatrix3x4dv(x,y,True,z),   (3,4)),
-        GL_DOUBLE_MAT4x2: (GLdouble, 8, lambda x,y,z: glUniformMatrix4x2dv(x,y,True,z),    (4,2)),
-        GL_DOUBLE_MAT4x3: (GLdouble, 12, lambda x,y,z: glUniformMatrix4x3dv(x,y,True,z),   (4,3)),
+        GL_DOUBLE_MAT2: (GLdouble, 4, glUniformMatrix2dv,      (2,2)),
+        GL_DOUBLE_MAT3: (GLdouble, 9, glUniformMatrix3dv,      (3,3)),
+        GL_DOUBLE_MAT4: (GLdouble, 16, glUniformMatrix4dv,     (4,4)),
+        GL_DOUBLE_MAT2x3: (GLdouble, 6, glUniformMatrix2x3dv,    (2,3)),
+        GL_DOUBLE_MAT2x4: (GLdouble, 8, glUniformMatrix2x4dv,    (2,4)),
+        GL_DOUBLE_MAT3x2: (GLdouble, 6, glUniformMatrix3x2dv,    (3,2)),
+        GL_DOUBLE_MAT3x4: (GLdouble, 12, glUniformMatrix3x4dv,   (3,4)),
+        GL_DOUBLE_MAT4x2: (GLdouble, 8, glUniformMatrix4x2dv,    (4,2)),
+        GL_DOUBLE_MAT4x3: (GLdouble, 12, glUniformMatrix4x3dv,   (4,3)),
     }
-    mod.UNIFORMS_DATA.update(uniform_data)
-    
\ No newline at end of file
+    for type, data in uniform_data.items():
+        mod.register_uniform_type(type, *data, transpose=True)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+''MIT License
+
+Copyright (c) 2016 Gabriel Dubé
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pyglet.gl import GLuint, gl_info
+from pyglet.gl.lib import link_GL
+
+# Same value for the KHR and the ARB extensions
+GL_COMPLETION_STATUS_KHR = 0x91B1
+
+# Let the driver choose the number of compiler threads
+GL_MAX_COMPILER_THREADS = 0xFFFFFFFF
+
+def supported():
+    " Requires GL_KHR_parallel_shader_compile or GL_ARB_parallel_shader_compile "
+    return (gl_info.have_extension('GL_KHR_parallel_shader_compile') or 
+            gl_info.have_extension('GL_ARB_parallel_shader_compile'))
+
+def load(mod):
+    if gl_info.have_extension('GL_KHR_parallel_shader_compile'):
+        max_threads = link_GL('glMaxShaderCompilerThreadsKHR', None, [GLuint], 'KHR_parallel_shader_compile')
+    else:
+        max_threads = link_GL('glMaxShaderCompilerThreadsARB', None, [GLuint], 'ARB_parallel_shader_compile')
+    
+    max_threads(GL_MAX_COMPILER_THREADS)
+    
+    # Add the completion status to the objects
+    mod.ShaderObject.completion_status = mod.GetShaderObject(GL_COMPLETION_STATUS_KHR)
+    mod.ShaderProgram.completion_status = mod.GetProgramObject(GL_COMPLETION_STATUS_KHR)
+    
+    mod.PARALLEL_COMPILE = True
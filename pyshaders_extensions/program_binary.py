@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+''MIT License
+
+Copyright (c) 2016 Gabriel Dubé
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pyglet.gl import (glGetProgramBinary, glProgramBinary, glProgramParameteri,
+  glGetIntegerv, GLenum, GLint, GLsizei, gl_info)
+
+from pyglet.gl import (GL_PROGRAM_BINARY_LENGTH, GL_PROGRAM_BINARY_RETRIEVABLE_HINT,
+  GL_NUM_PROGRAM_BINARY_FORMATS, GL_PROGRAM_BINARY_FORMATS, GL_TRUE)
+
+from ctypes import c_char, byref
+from struct import Struct
+import os, json
+
+# Set when the extension is loaded
+pyshaders = None
+
+# Program binary formats supported by the driver. Set when the extension is loaded
+BINARY_FORMATS = frozenset()
+
+# Header of a cached binary file: binary format
+HEADER = Struct('<I')
+
+# Version of the reflection metadata files. Files of other versions are ignored
+REFLECTION_VERSION = 1
+
+def binary(self):
+    """
+        Return the binary of the linked program as a (format, bytes) tuple.
+    """
+    length = self.binary_length
+    buf = (c_char*length)()
+    format = GLenum(0)
+    glGetProgramBinary(self.pid, length, byref(GLsizei(0)), byref(format), buf)
+    return format.value, bytes(buf)
+
+def load_binary(self, format, data, reflection=None):
+    """
+        Load a program binary returned by "binary". Return True if the driver
+        accepted the binary, False otherwise. Also reload the uniform cache if successful.
+
+        Arguments:
+            format: Binary format
+            data: Binary data
+            reflection: Reflection metadata of the program (see ShaderProgram.reflection). If not None,
+                        the caches are restored from the metadata instead of querying the program.
+    """
+    if format not in BINARY_FORMATS:
+        return False     # glProgramBinary raises an error for unknown formats
+
+    buf = (c_char*len(data)).from_buffer_copy(data)
+    glProgramBinary(self.pid, format, buf, len(data))
+    if self.link_status == GL_TRUE:
+        if reflection is None:
+            self.reload()
+        else:
+            self.restore_reflection(reflection)
+        return True
+
+    return False
+
+
+class ProgramBinaryCache(object):
+    """
+        Persistent cache of linked programs. Programs are stored on the disk
+        using glGetProgramBinary and restored with glProgramBinary.
+
+        The cache key is computed from the shaders sources and the driver identity,
+        so a driver update invalidates the cached binaries. If the driver
+        rejects a binary, the program is compiled and linked normally.
+
+        The reflection metadata of the programs (see ShaderProgram.reflection) is saved next to
+        the binaries, so a restored program rebuilds its uniforms and attributes caches without
+        querying OpenGL. Use verify_reflection(True) to check the metadata against the restored programs.
+
+        Pass the cache to from_string, from_files or from_files_names using the "cache" keyword argument.
+
+        Slots:
+            path: Directory where the binaries are saved
+            max_size: Maximum size of the cache in bytes. Least recently used binaries are evicted first.
+            identity: Driver identity mixed in the cache keys
+            hits: Number of programs restored from the cache
+            misses: Number of programs that had to be compiled
+            size: Size of the cache in bytes. The directory is only listed when the cache is created
+                  and when the size exceeds max_size.
+    """
+
+    __slots__ = ['path', 'max_size', 'identity', 'hits', 'misses', 'size']
+
+    def __init__(self, path, max_size=64*1024*1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.identity = pyshaders.driver_identity()
+        self.hits = 0
+        self.misses = 0
+        self.size = sum(e[1] for e in self.entries())
+
+    def key(self, verts, frags):
+        " Return the cache key of a set of sources "
+        return pyshaders.source_hash(verts, frags, *self.identity)
+
+    def filename(self, key):
+        " Return the name of the file associated with a key "
+        return os.path.join(self.path, key+'.bin')
+
+    @staticmethod
+    def reflection_filename(fname):
+        " Return the name of the reflection metadata file of a binary file "
+        return os.path.splitext(fname)[0]+'.json'
+
+    def load_reflection(self, fname):
+        " Return the reflection metadata saved with a binary or None if it is missing or invalid "
+        try:
+            with open(self.reflection_filename(fname), 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(meta, dict) or meta.get('version') != REFLECTION_VERSION:
+            return None
+
+        return meta.get('reflection')
+
+    def load(self, verts, frags):
+        """
+            Return a linked program from the cache or None if the sources were not
+            cached or if the driver rejected the cached binary.
+        """
+        fname = self.filename(self.key(verts, frags))
+        try:
+            with open(fname, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+
+        if len(data) > HEADER.size:
+            format, = HEADER.unpack_from(data)
+            prog = pyshaders.ShaderProgram.new_program()
+            if prog.load_binary(format, data[HEADER.size:], self.load_reflection(fname)):
+                os.utime(fname)    # The modification time is used to evict the least recently used binaries
+                self.hits += 1
+                return prog
+
+        # The binary is corrupted or was rejected by the driver
+        self.remove(fname)
+        self.misses += 1
+        return None
+
+    def prepare(self, prog):
+        " Called by the loading functions before a program is linked "
+        glProgramParameteri(prog.pid, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+
+    def store(self, verts, frags, prog):
+        " Save the binary of a linked program in the cache "
+        format, data = prog.binary()
+        if len(data) == 0:
+            return
+
+        fname = self.filename(self.key(verts, frags))
+        meta_fname = self.reflection_filename(fname)
+        old_size = self.file_size(fname) + self.file_size(meta_fname)
+
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'wb') as f:
+            f.write(HEADER.pack(format))
+            f.write(data)
+        os.replace(tmp_fname, fname)    # Other processes never see an incomplete binary
+
+        # The metadata is only written once the binary is saved, a binary without metadata is still valid
+        tmp_fname = '{}.{}.tmp'.format(meta_fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump({'version': REFLECTION_VERSION, 'reflection': prog.reflection()}, f)
+        os.replace(tmp_fname, meta_fname)
+
+        self.size += self.file_size(fname) + self.file_size(meta_fname) - old_size
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def entries(self):
+        """
+            Return the (modification time, size, file name) of the binaries in the cache. Sizes include the metadata.
+            Metadata files without a binary are returned with a modification time of 0, so they are evicted first.
+        """
+        names = os.listdir(self.path)
+        binaries = set(name for name in names if name.endswith('.bin'))
+
+        entries = []
+        for name in names:
+            fname = os.path.join(self.path, name)
+            if name.endswith('.json') and name[:-5]+'.bin' not in binaries:
+                entries.append((0, self.file_size(fname), fname))
+            elif name in binaries:
+                try:
+                    stat = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size+self.file_size(self.reflection_filename(fname)), fname))
+
+        return entries
+
+    def evict(self):
+        """
+            Remove the least recently used binaries until the cache fits in max_size.
+            The directory is listed again, so the binaries saved by other processes are counted.
+        """
+        entries = self.entries()
+        self.size = sum(e[1] for e in entries)
+        for mtime, fsize, fname in sorted(entries):
+            if mtime != 0 and self.size <= self.max_size:
+                break
+            self.remove(fname)
+
+    def clear(self):
+        " Remove every binary in the cache "
+        for name in os.listdir(self.path):
+            if name.endswith('.bin') or name.endswith('.json'):
+                self.remove(os.path.join(self.path, name))
+        self.size = 0
+
+    def remove(self, fname):
+        " Remove a binary and its reflection metadata "
+        for name in (fname, self.reflection_filename(fname)):
+            size = self.file_size(name)
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            self.size = max(self.size-size, 0)
+
+    @staticmethod
+    def file_size(fname):
+        " Return the size of a file or 0 if it does not exist "
+        try:
+            return os.path.getsize(fname)
+        except OSError:
+            return 0
+
+
+def supported():
+    " Requires OpenGL >= 4.1 or GL_ARB_get_program_binary "
+    if not (gl_info.have_version(4,1) or gl_info.have_extension('GL_ARB_get_program_binary')):
+        return False
+
+    formats = GLint(0)
+    glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, byref(formats))
+    return formats.value > 0
+
+def binary_formats():
+    " Return the program binary formats supported by the driver "
+    count = GLint(0)
+    glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, byref(count))
+    formats = (GLint*count.value)()
+    glGetIntegerv(GL_PROGRAM_BINARY_FORMATS, formats)
+    return frozenset(f & 0xFFFFFFFF for f in formats)     # The formats are saved unsigned in the binary files
+
+def load(mod):
+    global pyshaders, BINARY_FORMATS
+    pyshaders = mod
+    BINARY_FORMATS = binary_formats()
+
+    mod.ShaderProgram.binary_length = mod.GetProgramObject(GL_PROGRAM_BINARY_LENGTH)
+    mod.ShaderProgram.binary = binary
+    mod.ShaderProgram.load_binary = load_binary
+    mod.ProgramBinaryCache = ProgramBinaryCache
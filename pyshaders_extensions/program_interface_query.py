@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+''MIT License
+
+Copyright (c) 2016 Gabriel Dubé
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pyglet.gl import GLuint, GLenum, GLint, GLsizei, GLchar, gl_info
+from pyglet.gl.lib import link_GL
+
+from ctypes import POINTER, c_char, byref
+
+GL_UNIFORM = 0x92E1
+GL_PROGRAM_INPUT = 0x92E3
+GL_ACTIVE_RESOURCES = 0x92F5
+GL_MAX_NAME_LENGTH = 0x92F6
+GL_NAME_LENGTH = 0x92F9
+GL_TYPE = 0x92FA
+GL_ARRAY_SIZE = 0x92FB
+GL_BLOCK_INDEX = 0x92FD
+GL_LOCATION = 0x930E
+
+# Properties fetched with a single glGetProgramResourceiv call per resource
+UNIFORM_PROPERTIES = (GL_NAME_LENGTH, GL_TYPE, GL_ARRAY_SIZE, GL_LOCATION, GL_BLOCK_INDEX)
+INPUT_PROPERTIES = (GL_NAME_LENGTH, GL_TYPE, GL_ARRAY_SIZE, GL_LOCATION)
+
+# Set when the extension is loaded
+glGetProgramInterfaceiv = None
+glGetProgramResourceiv = None
+glGetProgramResourceName = None
+
+def query_resources(pid, interface, properties):
+    """
+        Return the (name, type, size, location) of the active resources of a program interface.
+        The properties of a resource are fetched with a single call and the names are decoded
+        without copying the whole name buffer.
+    """
+    count, maxlength = GLint(0), GLint(0)
+    glGetProgramInterfaceiv(pid, interface, GL_ACTIVE_RESOURCES, byref(count))
+    glGetProgramInterfaceiv(pid, interface, GL_MAX_NAME_LENGTH, byref(maxlength))
+
+    props = (GLenum*len(properties))(*properties)
+    values = (GLint*len(properties))()
+    name_buf = (c_char*max(maxlength.value, 1))()
+
+    resources = []
+    for i in range(count.value):
+        glGetProgramResourceiv(pid, interface, i, len(props), props, len(values), None, values)
+        name_length, type, size, loc = values[0:4]
+
+        glGetProgramResourceName(pid, interface, i, len(name_buf), None, name_buf)
+        name = name_buf[0:name_length-1].decode('UTF-8')      # NAME_LENGTH includes the null terminator
+
+        if len(properties) > 4 and values[4] != -1:
+            loc = -1    # Uniform blocks members do not have a location
+
+        resources.append((name, type, size, loc))
+
+    return resources
+
+def query_uniforms(self, prog, *args):
+    " Reflect the uniforms with glGetProgramResourceiv "
+    return query_resources(prog.pid, GL_UNIFORM, UNIFORM_PROPERTIES)
+
+def query_attributes(self, prog, *args):
+    " Reflect the attributes with glGetProgramResourceiv "
+    return query_resources(prog.pid, GL_PROGRAM_INPUT, INPUT_PROPERTIES)
+
+
+def supported():
+    " Requires OpenGL >= 4.3 or GL_ARB_program_interface_query "
+    return gl_info.have_version(4,3) or gl_info.have_extension('GL_ARB_program_interface_query')
+
+def load(mod):
+    global glGetProgramInterfaceiv, glGetProgramResourceiv, glGetProgramResourceName
+
+    glGetProgramInterfaceiv = link_GL('glGetProgramInterfaceiv', None,
+      [GLuint, GLenum, GLenum, POINTER(GLint)], 'ARB_program_interface_query')
+    glGetProgramResourceiv = link_GL('glGetProgramResourceiv', None,
+      [GLuint, GLenum, GLuint, GLsizei, POINTER(GLenum), GLsizei, POINTER(GLsizei), POINTER(GLint)], 'ARB_program_interface_query')
+    glGetProgramResourceName = link_GL('glGetProgramResourceName', None,
+      [GLuint, GLenum, GLuint, GLsizei, POINTER(GLsizei), POINTER(GLchar)], 'ARB_program_interface_query')
+
+    mod.ShaderUniformAccessor.query = query_uniforms
+    mod.ShaderAttributeAccessor.query = query_attributes
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+''MIT License
+
+Copyright (c) 2016 Gabriel Dubé
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pyglet.gl import (glProgramUniform1fv, glProgramUniform2fv, glProgramUniform3fv, glProgramUniform4fv,
+  glProgramUniform1iv, glProgramUniform2iv, glProgramUniform3iv, glProgramUniform4iv,
+  glProgramUniform1uiv, glProgramUniform2uiv, glProgramUniform3uiv, glProgramUniform4uiv,
+  glProgramUniform1dv, glProgramUniform2dv, glProgramUniform3dv, glProgramUniform4dv,
+  glProgramUniformMatrix2fv, glProgramUniformMatrix3fv, glProgramUniformMatrix4fv,
+  glProgramUniformMatrix2x3fv, glProgramUniformMatrix2x4fv, glProgramUniformMatrix3x2fv,
+  glProgramUniformMatrix3x4fv, glProgramUniformMatrix4x2fv, glProgramUniformMatrix4x3fv,
+  glProgramUniformMatrix2dv, glProgramUniformMatrix3dv, glProgramUniformMatrix4dv,
+  glProgramUniformMatrix2x3dv, glProgramUniformMatrix2x4dv, glProgramUniformMatrix3x2dv,
+  glProgramUniformMatrix3x4dv, glProgramUniformMatrix4x2dv, glProgramUniformMatrix4x3dv, gl_info)
+
+from pyglet.gl import (GL_FLOAT, GL_FLOAT_VEC2, GL_FLOAT_VEC3, GL_FLOAT_VEC4, GL_INT, GL_INT_VEC2,
+  GL_INT_VEC3, GL_INT_VEC4, GL_UNSIGNED_INT, GL_UNSIGNED_INT_VEC2, GL_UNSIGNED_INT_VEC3,
+  GL_UNSIGNED_INT_VEC4, GL_DOUBLE, GL_DOUBLE_VEC2, GL_DOUBLE_VEC3, GL_DOUBLE_VEC4,
+  GL_FLOAT_MAT2, GL_FLOAT_MAT3, GL_FLOAT_MAT4, GL_FLOAT_MAT2x3, GL_FLOAT_MAT2x4, GL_FLOAT_MAT3x2,
+  GL_FLOAT_MAT3x4, GL_FLOAT_MAT4x2, GL_FLOAT_MAT4x3, GL_DOUBLE_MAT2, GL_DOUBLE_MAT3, GL_DOUBLE_MAT4,
+  GL_DOUBLE_MAT2x3, GL_DOUBLE_MAT2x4, GL_DOUBLE_MAT3x2, GL_DOUBLE_MAT3x4, GL_DOUBLE_MAT4x2,
+  GL_DOUBLE_MAT4x3)
+
+# Set when the extension is loaded
+pyshaders = None
+
+def supported():
+    " Requires OpenGL >= 4.1 or GL_ARB_separate_shader_objects "
+    return gl_info.have_version(4,1) or gl_info.have_extension('GL_ARB_separate_shader_objects')
+
+def load(mod):
+    global pyshaders
+    pyshaders = mod
+    
+    # Types that are not in UNIFORMS_DATA (ex: double_uniforms is not loaded) are never used.
+    # The setters pass the program id first and the transpose argument of the matrices.
+    program_setters = {
+        GL_FLOAT: glProgramUniform1fv,
+        GL_FLOAT_VEC2: glProgramUniform2fv,
+        GL_FLOAT_VEC3: glProgramUniform3fv,
+        GL_FLOAT_VEC4: glProgramUniform4fv,
+        GL_INT: glProgramUniform1iv,
+        GL_INT_VEC2: glProgramUniform2iv,
+        GL_INT_VEC3: glProgramUniform3iv,
+        GL_INT_VEC4: glProgramUniform4iv,
+        GL_UNSIGNED_INT: glProgramUniform1uiv,
+        GL_UNSIGNED_INT_VEC2: glProgramUniform2uiv,
+        GL_UNSIGNED_INT_VEC3: glProgramUniform3uiv,
+        GL_UNSIGNED_INT_VEC4: glProgramUniform4uiv,
+        GL_DOUBLE: glProgramUniform1dv,
+        GL_DOUBLE_VEC2: glProgramUniform2dv,
+        GL_DOUBLE_VEC3: glProgramUniform3dv,
+        GL_DOUBLE_VEC4: glProgramUniform4dv,
+        GL_FLOAT_MAT2: glProgramUniformMatrix2fv,
+        GL_FLOAT_MAT3: glProgramUniformMatrix3fv,
+        GL_FLOAT_MAT4: glProgramUniformMatrix4fv,
+        GL_FLOAT_MAT2x3: glProgramUniformMatrix2x3fv,
+        GL_FLOAT_MAT2x4: glProgramUniformMatrix2x4fv,
+        GL_FLOAT_MAT3x2: glProgramUniformMatrix3x2fv,
+        GL_FLOAT_MAT3x4: glProgramUniformMatrix3x4fv,
+        GL_FLOAT_MAT4x2: glProgramUniformMatrix4x2fv,
+        GL_FLOAT_MAT4x3: glProgramUniformMatrix4x3fv,
+        GL_DOUBLE_MAT2: glProgramUniformMatrix2dv,
+        GL_DOUBLE_MAT3: glProgramUniformMatrix3dv,
+        GL_DOUBLE_MAT4: glProgramUniformMatrix4dv,
+        GL_DOUBLE_MAT2x3: glProgramUniformMatrix2x3dv,
+        GL_DOUBLE_MAT2x4: glProgramUniformMatrix2x4dv,
+        GL_DOUBLE_MAT3x2: glProgramUniformMatrix3x2dv,
+        GL_DOUBLE_MAT3x4: glProgramUniformMatrix3x4dv,
+        GL_DOUBLE_MAT4x2: glProgramUniformMatrix4x2dv,
+        GL_DOUBLE_MAT4x3: glProgramUniformMatrix4x3dv,
+    }
+    mod.PROGRAM_SETTERS.update(program_setters)
+    mod.direct_uniforms(True)
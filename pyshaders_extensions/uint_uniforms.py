@@ -50,11 +50,8 @@ def supported():
     return check_requirements(target_gl=(3,0), target_glsl=(1,30))
 
 def load(mod):
-    # Add getters
-    mod.GETTERS[GLuint] = glGetUniformuiv
-    
-    # To unpack array correctly
-    mod.UNPACK_ARRAY.append(GL_UNSIGNED_INT)
+    # Add getters and buffer protocol format
+    mod.register_uniform_component(GLuint, glGetUniformuiv, 'IL')
     
     # Add uniform data
     uniform_data = {
@@ -63,5 +60,5 @@ def load(mod):
         GL_UNSIGNED_INT_VEC3: (GLuint, 3, glUniform3uiv),
         GL_UNSIGNED_INT_VEC4: (GLuint, 4, glUniform4uiv),
     }
-    mod.UNIFORMS_DATA.update(uniform_data)
-    
\ No newline at end of file
+    for type, data in uniform_data.items():
+        mod.register_uniform_type(type, *data)
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+''MIT License
+
+Copyright (c) 2016 Gabriel Dubé
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from pyglet.gl import (glGetActiveUniformBlockiv, glGetActiveUniformBlockName,
+  glGetActiveUniformsiv, glGetActiveUniformName, glGetUniformBlockIndex, glUniformBlockBinding,
+  glGenBuffers, glDeleteBuffers, glBindBuffer, glBindBufferBase, glBufferData, glBufferSubData,
+  GLint, GLuint, GLsizei, gl_info)
+
+from pyglet.gl import (GL_ACTIVE_UNIFORM_BLOCKS, GL_ACTIVE_UNIFORM_BLOCK_MAX_NAME_LENGTH,
+  GL_UNIFORM_BLOCK_DATA_SIZE, GL_UNIFORM_BLOCK_BINDING, GL_UNIFORM_BLOCK_ACTIVE_UNIFORMS,
+  GL_UNIFORM_BLOCK_ACTIVE_UNIFORM_INDICES, GL_UNIFORM_TYPE, GL_UNIFORM_SIZE, GL_UNIFORM_OFFSET,
+  GL_UNIFORM_ARRAY_STRIDE, GL_UNIFORM_MATRIX_STRIDE, GL_UNIFORM_IS_ROW_MAJOR, GL_UNIFORM_BUFFER,
+  GL_DYNAMIC_DRAW, GL_INVALID_INDEX)
+
+from ctypes import c_char, byref, sizeof
+from collections import namedtuple
+from struct import Struct, error as StructError
+
+# Set when the extension is loaded
+pyshaders = None
+
+BlockMember = namedtuple('BlockMember', ['name', 'type', 'size', 'offset', 'array_stride', 'matrix_stride', 'row_major'])
+BlockInfo = namedtuple('BlockInfo', ['index', 'name', 'binding', 'data_size', 'members'])
+
+round_up = lambda value, align: (value + align - 1) // align * align
+
+def type_shape(type):
+    """
+        Return the (c_type, columns, rows) of an uniform type. Vectors and scalars have a single column.
+    """
+    try:
+        c_type, bcount, setter, *mat_size = pyshaders.UNIFORMS_DATA[type]
+    except KeyError:
+        raise ValueError('Unsupported uniform type: {}'.format(type)) from None
+
+    if len(mat_size) == 1:
+        return (c_type,) + tuple(mat_size[0])
+
+    return c_type, 1, bcount
+
+def block_layout(members, layout='std140'):
+    """
+        Compute the offsets of the members of an uniform block declared with the std140 or the std430 layout.
+        Matrices are column major.
+
+        Arguments:
+            members: Sequence of (name, type) or (name, type, array_length) tuples, in the declaration order
+            layout: 'std140' or 'std430'
+
+        Return a tuple (members, data_size) where members is a tuple of BlockMember.
+    """
+    if layout not in ('std140', 'std430'):
+        raise ValueError('Unknown layout "{}"'.format(layout))
+
+    std140 = layout == 'std140'
+    offset = 0
+    block_align = 16 if std140 else 1
+    layout_members = []
+
+    for name, type, *length in members:
+        c_type, cols, rows = type_shape(type)
+        is_array = len(length) == 1
+        size = length[0] if is_array else 1
+
+        n = sizeof(c_type)
+        vec_align = n*(4 if rows == 3 else rows)
+        array_stride = matrix_stride = 0
+
+        if cols > 1 or is_array:
+            # Matrices are arrays of columns. In std140, the stride of an array is rounded up to a vec4
+            align = round_up(vec_align, 16) if std140 else vec_align
+            matrix_stride = align if cols > 1 else 0
+            element_size = align*cols
+            array_stride = element_size if is_array else 0
+            member_size = element_size*size
+        else:
+            align = vec_align
+            member_size = n*rows
+
+        offset = round_up(offset, align)
+        layout_members.append(BlockMember(name, type, size, offset, array_stride, matrix_stride, False))
+        offset += member_size
+        block_align = max(block_align, align)
+
+    return tuple(layout_members), round_up(offset, block_align)
+
+
+def uniform_blocks(self):
+    """
+        Return the active uniform blocks of the program in a dict of BlockInfo, by block name.
+        Block members are sorted by offset.
+    """
+    pid = self.pid
+    blocks = {}
+
+    name_length = max(self.max_uniform_block_length, self.max_uniform_length)
+    name_buf = (c_char*name_length)()
+    length = GLsizei(0)
+    value = GLint(0)
+
+    for index in range(self.uniform_blocks_count):
+        glGetActiveUniformBlockName(pid, index, name_length, byref(length), name_buf)
+        block_name = name_buf.raw[0:length.value].decode('UTF-8')
+
+        glGetActiveUniformBlockiv(pid, index, GL_UNIFORM_BLOCK_DATA_SIZE, byref(value))
+        data_size = value.value
+        glGetActiveUniformBlockiv(pid, index, GL_UNIFORM_BLOCK_BINDING, byref(value))
+        binding = value.value
+        glGetActiveUniformBlockiv(pid, index, GL_UNIFORM_BLOCK_ACTIVE_UNIFORMS, byref(value))
+        count = value.value
+
+        indices = (GLint*count)()
+        glGetActiveUniformBlockiv(pid, index, GL_UNIFORM_BLOCK_ACTIVE_UNIFORM_INDICES, indices)
+        indices = (GLuint*count)(*indices)
+
+        # One query per property for all the members of the block
+        properties = []
+        for pname in (GL_UNIFORM_TYPE, GL_UNIFORM_SIZE, GL_UNIFORM_OFFSET, GL_UNIFORM_ARRAY_STRIDE,
+                      GL_UNIFORM_MATRIX_STRIDE, GL_UNIFORM_IS_ROW_MAJOR):
+            buf = (GLint*count)()
+            glGetActiveUniformsiv(pid, count, indices, pname, buf)
+            properties.append(buf)
+
+        members = []
+        for i, uindex in enumerate(indices):
+            glGetActiveUniformName(pid, uindex, name_length, byref(length), name_buf)
+            name = name_buf.raw[0:length.value].decode('UTF-8')
+            if name.endswith('[0]'):     # Only the last index, the elements of the struct arrays keep their index
+                name = name[:-3]
+            if name.startswith(block_name+'.'):
+                name = name[len(block_name)+1:]
+
+            type, size, offset, array_stride, matrix_stride, row_major = [p[i] for p in properties]
+            members.append(BlockMember(name, type, size, offset, array_stride, matrix_stride, bool(row_major)))
+
+        members.sort(key=lambda m: m.offset)
+        blocks[block_name] = BlockInfo(index, block_name, binding, data_size, tuple(members))
+
+    return blocks
+
+def bind_uniform_block(self, name, binding):
+    """
+        Assign a binding point to an uniform block of the program
+
+        Arguments:
+            name: Name of the uniform block
+            binding: Index of the binding point
+    """
+    index = glGetUniformBlockIndex(self.pid, name.encode('UTF-8'))
+    if index == GL_INVALID_INDEX:
+        raise AttributeError('No uniform block named "{}" found'.format(name))
+
+    glUniformBlockBinding(self.pid, index, binding)
+
+
+class BlockMemberPacker(object):
+    """
+        Pack and unpack the values of a block member. The member components are written
+        with a single struct call. Matrices are packed according to TRANSPOSE_MATRIX, so
+        the values have the same layout as the values sent to the uniforms setters.
+
+        Slots:
+            member: Block member (BlockMember)
+            shape: Columns and rows of the member type
+            length: Number of components in the member
+            start: Offset of the first component in the block
+            struct: Struct of the member components, padding included
+            order: Index of the values packed by the struct, by TRANSPOSE_MATRIX value. None if the values are not reordered.
+    """
+
+    __slots__ = ['member', 'shape', 'length', 'start', 'struct', 'order']
+
+    def __init__(self, member):
+        c_type, cols, rows = type_shape(member.type)
+        self.member = member
+        self.shape = (cols, rows)
+        self.length = cols*rows*member.size
+
+        order = {}
+        for transpose in (False, True):
+            offsets = self.offsets(sizeof(c_type), transpose)
+            order[transpose] = sorted(range(len(offsets)), key=offsets.__getitem__)
+
+        offsets = sorted(offsets)
+        self.start = offsets[0]
+
+        fmt, end = ['='], self.start
+        for offset in offsets:
+            if offset > end:
+                fmt.append('{}x'.format(offset-end))
+            fmt.append(c_type._type_)
+            end = offset + sizeof(c_type)
+        self.struct = Struct(''.join(fmt))
+
+        identity = list(range(self.length))
+        self.order = None if order[False] == order[True] == identity else order
+
+    def offsets(self, n, transpose):
+        " Return the offsets of the member components, in the order of the values "
+        m = self.member
+        cols, rows = self.shape
+        offsets = []
+        for e in range(m.size):
+            base = m.offset + e*m.array_stride
+            if cols == 1:
+                offsets.extend(base + i*n for i in range(rows))
+                continue
+
+            for k in range(cols*rows):
+                if transpose:
+                    r, c = divmod(k, cols)
+                else:
+                    c, r = divmod(k, rows)
+                if m.row_major:
+                    offsets.append(base + r*m.matrix_stride + c*n)
+                else:
+                    offsets.append(base + c*m.matrix_stride + r*n)
+
+        return offsets
+
+    def pack(self, data, value):
+        flat = flatten(value, [])
+        if len(flat) > self.length:
+            raise IndexError('Too many values for uniform block member "{}"'.format(self.member.name))
+        flat.extend([0]*(self.length-len(flat)))
+
+        if self.order is not None:
+            flat = [flat[i] for i in self.order[pyshaders.TRANSPOSE_MATRIX]]
+
+        try:
+            self.struct.pack_into(data, self.start, *flat)
+        except StructError as e:
+            raise TypeError(str(e)) from None
+
+    def unpack(self, data):
+        values = self.struct.unpack_from(data, self.start)
+        if self.order is not None:
+            flat = [0]*self.length
+            for value, i in zip(values, self.order[pyshaders.TRANSPOSE_MATRIX]):
+                flat[i] = value
+            values = flat
+
+        cols, rows = self.shape
+        element = rows
+        if cols > 1:
+            inner = cols if pyshaders.TRANSPOSE_MATRIX else rows
+            values = [tuple(values[i:i+inner]) for i in range(0, len(values), inner)]
+            element = cols*rows//inner
+
+        if element > 1:
+            values = [tuple(values[i:i+element]) for i in range(0, len(values), element)]
+
+        if self.member.array_stride == 0:
+            return values[0]
+        return tuple(values)
+
+def flatten(value, out):
+    " Flatten nested sequences of numbers in out "
+    if hasattr(value, '__iter__') and not isinstance(value, (str, bytes)):
+        for v in value:
+            flatten(v, out)
+    else:
+        out.append(value)
+    return out
+
+
+class UniformBlock(object):
+    """
+        Values of an uniform block stored in a python buffer (data) and in an uniform buffer object.
+        The values are packed in the python buffer when set and uploaded with a single glBufferSubData call by upload or bind.
+        Bind the block to the binding point of the programs that use it, a single upload serves every program.
+
+        Values are set and read with the member names: block['view'] = ((1.0, 0.0, 0.0, 0.0), ...)
+
+        Slots:
+            members: Block members by name (BlockMember)
+            packers: Objects that pack the members values in the buffer
+            size: Size of the block in bytes
+            data: Python buffer (bytearray) holding the block values
+            buffer: Uniform buffer object id
+            dirty: If data was modified since the last upload
+    """
+
+    __slots__ = ['members', 'packers', 'size', 'data', 'data_ptr', 'buffer', 'dirty']
+
+    def __init__(self, members, size):
+        """
+            Create an uniform block with the given layout. See from_program and from_layout.
+
+            Arguments:
+                members: Sequence of BlockMember
+                size: Size of the block in bytes
+        """
+        self.members = {m.name: m for m in members}
+        self.packers = {}
+        for m in members:
+            try:
+                self.packers[m.name] = BlockMemberPacker(m)
+            except ValueError:
+                pass           # Types that are not supported by the loaded extensions are ignored
+
+        self.size = size
+        self.data = bytearray(size)
+        self.data_ptr = (c_char*size).from_buffer(self.data)
+        self.dirty = True
+
+        self.buffer = GLuint(0)
+        glGenBuffers(1, byref(self.buffer))
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferData(GL_UNIFORM_BUFFER, size, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+    @classmethod
+    def from_program(cls, program, name):
+        """
+            Create an uniform block using the layout of the block "name" in a linked program.
+            The offsets are queried from the driver, so any layout (shared, packed, std140) can be used.
+        """
+        info = program.uniform_blocks().get(name)
+        if info is None:
+            raise AttributeError('No uniform block named "{}" found'.format(name))
+
+        return cls(info.members, info.data_size)
+
+    @classmethod
+    def from_layout(cls, members, layout='std140'):
+        """
+            Create an uniform block without a program. The offsets are computed with block_layout.
+        """
+        members, size = block_layout(members, layout)
+        return cls(members, size)
+
+    def upload(self):
+        " Send the block values to the uniform buffer if they were modified "
+        if self.dirty:
+            glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+            glBufferSubData(GL_UNIFORM_BUFFER, 0, self.size, self.data_ptr)
+            glBindBuffer(GL_UNIFORM_BUFFER, 0)
+            self.dirty = False
+
+    def bind(self, binding):
+        " Upload the values if needed and bind the uniform buffer to a binding point "
+        self.upload()
+        glBindBufferBase(GL_UNIFORM_BUFFER, binding, self.buffer)
+
+    def update(self, values):
+        " Set many members from a mapping of names to values "
+        for name, value in values.items():
+            self[name] = value
+
+    def packer(self, name):
+        packer = self.packers.get(name)
+        if packer is None:
+            raise KeyError('No uniform block member named "{}" found'.format(name))
+        return packer
+
+    def __getitem__(self, name):
+        return self.packer(name).unpack(self.data)
+
+    def __setitem__(self, name, value):
+        self.packer(name).pack(self.data, value)
+        self.dirty = True
+
+    def __contains__(self, name):
+        return name in self.packers
+
+    def __iter__(self):
+        " Iterate over the members names "
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __del__(self):
+        if self.buffer.value != 0:
+            glDeleteBuffers(1, byref(self.buffer))
+            self.buffer.value = 0
+
+
+def supported():
+    " Requires OpenGL >= 3.1 or GL_ARB_uniform_buffer_object "
+    return gl_info.have_version(3,1) or gl_info.have_extension('GL_ARB_uniform_buffer_object')
+
+def load(mod):
+    global pyshaders
+    pyshaders = mod
+
+    mod.ShaderProgram.uniform_blocks_count = mod.GetProgramObject(GL_ACTIVE_UNIFORM_BLOCKS)
+    mod.ShaderProgram.max_uniform_block_length = mod.GetProgramObject(GL_ACTIVE_UNIFORM_BLOCK_MAX_NAME_LENGTH)
+    mod.ShaderProgram.uniform_blocks = uniform_blocks
+    mod.ShaderProgram.bind_uniform_block = bind_uniform_block
+    mod.BlockMember = BlockMember
+    mod.block_layout = block_layout
+    mod.UniformBlock = UniformBlock
@@ -1,19 +1,31 @@
 # -*- coding: utf-8 -*-
 
-import unittest, gc
+import unittest, gc, os, tempfile, shutil, asyncio, struct, json
+from unittest import mock
 from io import SEEK_END
-from ctypes import c_char_p, cast, sizeof
+from ctypes import c_char, c_char_p, cast, sizeof
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import pyglet
 from pyglet.gl import (glIsShader, GL_FALSE, GL_VERTEX_SHADER, GL_FRAGMENT_SHADER,
   glCreateShader, GL_TRUE, glDeleteShader, glIsProgram, glCreateProgram,
-  glDeleteProgram, GL_DOUBLE, GL_FLOAT, GL_INT)
+  glDeleteProgram, glUniform3f, GLfloat, GL_DOUBLE, GL_FLOAT, GL_INT,
+  glBindBuffer, glGetBufferSubData, GL_UNIFORM_BUFFER, GL_FLOAT_MAT4, GL_FLOAT_VEC2,
+  glGetActiveUniform, glGetUniformLocation, glGetActiveAttrib, glGetAttribLocation,
+  GL_COMPILE_STATUS, GL_LINK_STATUS)
 
 import pyshaders
 from pyshaders import (ShaderObject, ShaderCompilationError, shader_source,
-  ShaderProgram, from_files, from_files_names, current_program, GL_FLOAT_MAT3,
+  ShaderProgram, from_files, from_files_names, from_string, current_program, GL_FLOAT_MAT3,
   GL_FLOAT_VEC3, load_extension, check_extension, PyShadersExtensionError,
-  extension_loaded)
+  extension_loaded, ProgramCache, ShaderObjectPool, build_async, uniform_path,
+  ProgramBatch, GLScheduler, from_files_names_async, ShaderPreprocessor,
+  ShaderWatcher)
 
 vert_path = lambda fname: 'fixtures/{}.glsl.vert'.format(fname)
 frag_path = lambda fname: 'fixtures/{}.glsl.frag'.format(fname)
@@ -106,6 +118,22 @@ class TestShaderObjects(unittest.TestCase):
         
         srcf.close()
         
+    def test_source_chunks(self):
+        " Test setting the source with many strings "
+        with open(vert_path('shader1'), 'r') as f:
+            src = f.read()
+        
+        vert_obj = ShaderObject.vertex()
+        vert_obj.source = [src[0:13], src[13:]]    # Version and body
+        self.assertEqual(len(src)+1, vert_obj.source_length)
+        self.assertEqual(src, vert_obj.source[0:-1])
+        self.assertTrue(vert_obj.compile(), 'compilation failed')
+        
+        with open(frag_path('shader1'), 'r') as f:
+            frag = f.read()
+        shader = from_string([[src[0:13], src[13:]]], frag)
+        self.assertEqual(23, len(shader.uniforms))
+        
     def test_compile(self):
         " Test compile "
         srcf = open(vert_path('shader1'), 'r')
@@ -597,6 +625,20 @@ class TestUniforms(unittest.TestCase):
         uni.test_mat3 = ((5.0, 8.0, 7.0), (2.0, 4.0, 21.0))
         self.assertEqual(((5.0, 8.0, 7.0), (2.0, 4.0, 21.0), (0.0, 0.0, 0.0)), uni.test_mat3)
         
+    def test_set_uniforms_iterables(self):
+        " Set array and matrix uniforms with iterables without a length "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        
+        uni.test_array_float = (float(x) for x in range(4))
+        self.assertEqual((0.0, 1.0, 2.0, 3.0), uni.test_array_float)
+        
+        uni.test_array_vec3 = (iter((float(i), 2.0, 3.0)) for i in range(2))
+        self.assertEqual(((0.0, 2.0, 3.0), (1.0, 2.0, 3.0)), uni.test_array_vec3)
+        
+        with self.assertRaises(IndexError):
+            uni.test_array_float = (float(x) for x in range(5))
              
     def test_set_uniform_bad_values(self):
         " Set an uniform data with data of incorrect type "
@@ -624,6 +666,557 @@ class TestUniforms(unittest.TestCase):
         with self.assertRaises(IndexError, msg='Overflow assign succeed'):
             uni.test_array_vec3 = ((8.0, 6.0, 16.0, 17.0, 9.0, 2.0, 8.0),)
 
+
+    def test_uniforms_shadow(self):
+        " Redundant uniform writes are skipped "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        stats = uni.stats
+        shader.use()
+        
+        uni.test_vec3 = (1.0, 2.0, 3.0)
+        uni.test_vec3 = (1.0, 2.0, 3.0)
+        self.assertEqual((1, 1), (stats.issued, stats.skipped))
+        
+        uni.test_vec3 = (1.0, 2.0, 4.0)
+        self.assertEqual((2, 1), (stats.issued, stats.skipped))
+        
+        # Values set outside the api
+        glUniform3f(uni['test_vec3'].loc, 5.0, 5.0, 5.0)
+        uni.invalidate()
+        uni.test_vec3 = (1.0, 2.0, 4.0)
+        self.assertEqual((1.0, 2.0, 4.0), uni.test_vec3)
+        self.assertEqual((3, 1), (stats.issued, stats.skipped))
+        
+        # Matrix writes depend on the transpose flag
+        pyshaders.transpose_matrices(False)
+        uni.test_mat2 = ((5.0, 8.0), (2.0, 4.0))
+        pyshaders.transpose_matrices(True)
+        uni.test_mat2 = ((5.0, 8.0), (2.0, 4.0))
+        self.assertEqual(((5.0, 8.0), (2.0, 4.0)), uni.test_mat2)
+        self.assertEqual((5, 1), (stats.issued, stats.skipped))
+        
+        # Linking the program forgets the values
+        shader.link()
+        shader.use()
+        uni.test_mat2 = ((5.0, 8.0), (2.0, 4.0))
+        self.assertEqual((6, 1), (stats.issued, stats.skipped))
+        
+        stats.reset()
+        self.assertEqual((0, 0), (stats.issued, stats.skipped))
+
+    def test_uniforms_failed_write(self):
+        " A write that fails does not change the uniform "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        stats = uni.stats
+        shader.use()
+        
+        uni.test_array_vec3 = ((8.0, 6.0, 80.0), (5.0, 17.0, 45.0))
+        with self.assertRaises(TypeError):
+            uni.test_array_vec3 = ((1.0, 1.0, 1.0), (2.0, 'a', 2.0))
+        with self.assertRaises(IndexError):
+            uni.test_array_vec3 = ((1.0, 1.0, 1.0), (2.0, 2.0, 2.0), (3.0,))
+            
+        uni.test_array_vec3 = ((8.0, 6.0, 80.0), (5.0, 17.0, 45.0))
+        self.assertEqual(((8.0, 6.0, 80.0), (5.0, 17.0, 45.0)), uni.test_array_vec3)
+        self.assertEqual((1, 1), (stats.issued, stats.skipped))
+
+    def test_uniforms_failed_write_deferred(self):
+        " A deferred write that fails does not change the pending value "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        uni.defer()
+        try:
+            uni.test_array_vec3 = ((8.0, 6.0, 80.0), (5.0, 17.0, 45.0))
+            with self.assertRaises(TypeError):
+                uni.test_array_vec3 = ((1.0, 1.0, 1.0), (2.0, 'a', 2.0))
+            with self.assertRaises(IndexError):
+                uni.test_array_vec3 = ((1.0, 1.0, 1.0), (2.0, 2.0, 2.0), (3.0,))
+                
+            shader.use()
+            self.assertEqual(((8.0, 6.0, 80.0), (5.0, 17.0, 45.0)), uni.test_array_vec3)
+        finally:
+            uni.defer(False)
+
+    def test_set_uniforms_buffer(self):
+        " Set uniforms with objects supporting the buffer protocol "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        pyshaders.transpose_matrices(True)
+        
+        uni.test_vec3 = array('f', (1.0, 2.0, 3.0))
+        self.assertEqual((1.0, 2.0, 3.0), uni.test_vec3)
+        
+        uni.test_ivec2 = memoryview(bytes(array('i', (5, 6)))).cast('i')       # Read only
+        self.assertEqual((5, 6), uni.test_ivec2)
+        
+        uni.test_mat2 = (GLfloat*4)(5.0, 8.0, 2.0, 4.0)
+        self.assertEqual(((5.0, 8.0), (2.0, 4.0)), uni.test_mat2)
+        
+        mats = array('f', range(12))
+        uni.test_array_mat2 = mats
+        self.assertEqual((((0.0, 1.0), (2.0, 3.0)), ((4.0, 5.0), (6.0, 7.0)), ((8.0, 9.0), (10.0, 11.0))), uni.test_array_mat2)
+        
+        # Not contiguous
+        uni.test_array_float = memoryview(array('f', range(8)))[::2]
+        self.assertEqual((0.0, 2.0, 4.0, 6.0), uni.test_array_float)
+        
+        # Format or size that do not match are iterated
+        uni.test_array_float = array('d', (1.0, 2.0))
+        self.assertEqual((1.0, 2.0, 0.0, 0.0), uni.test_array_float)
+        
+        # Buffers work with the shadow copy
+        stats = uni.stats
+        stats.reset()
+        uni.test_array_mat2 = mats
+        uni.test_array_mat2 = (((0.0, 1.0), (2.0, 3.0)), ((4.0, 5.0), (6.0, 7.0)), ((8.0, 9.0), (10.0, 11.0)))
+        self.assertEqual((0, 2), (stats.issued, stats.skipped))
+        mats[0] = 20.0
+        uni.test_array_mat2 = mats
+        self.assertEqual((1, 2), (stats.issued, stats.skipped))
+        
+    @unittest.skipUnless(numpy is not None, 'numpy is not installed')
+    def test_set_uniforms_numpy(self):
+        " Set uniforms with numpy arrays "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        
+        mat = numpy.array(((1.0, 2.0, 3.0), (4.0, 5.0, 6.0), (7.0, 8.0, 9.0)), dtype=numpy.float32)
+        expected = ((1.0, 2.0, 3.0), (4.0, 5.0, 6.0), (7.0, 8.0, 9.0))
+        for transpose in (True, False):
+            pyshaders.transpose_matrices(transpose)
+            uni.test_mat3 = ((0.0,),)
+            uni.test_mat3 = mat
+            c_order = uni.test_mat3
+            uni.test_mat3 = ((0.0,),)
+            uni.test_mat3 = numpy.asfortranarray(mat)
+            self.assertEqual(c_order, uni.test_mat3)
+            uni.test_mat3 = expected
+            self.assertEqual(c_order, uni.test_mat3)
+            if transpose:
+                self.assertEqual(expected, c_order)
+            
+        pyshaders.transpose_matrices(True)
+        
+        mats = numpy.arange(12, dtype=numpy.float32).reshape((3, 2, 2))
+        uni.test_array_mat2 = mats
+        self.assertEqual((((0.0, 1.0), (2.0, 3.0)), ((4.0, 5.0), (6.0, 7.0)), ((8.0, 9.0), (10.0, 11.0))), uni.test_array_mat2)
+        
+        uni.test_array_vec3 = numpy.array(((1.0, 2.0, 3.0), (4.0, 5.0, 6.0)))     # float64 are converted
+        self.assertEqual(((1.0, 2.0, 3.0), (4.0, 5.0, 6.0)), uni.test_array_vec3)
+
+    def test_set_uniforms_many(self):
+        " Set many uniforms at once "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        
+        uni.update({'test_float': 2.5, 'test_ivec2': (3, 4), 'test_vec3': (1.0, 2.0, 3.0)})
+        self.assertEqual((2.5, (3, 4), (1.0, 2.0, 3.0)), (uni.test_float, uni.test_ivec2, uni.test_vec3))
+        
+        uni.update([('test_float', 4.5), ('test_int', 8)], sort=True)
+        self.assertEqual((4.5, 8), (uni.test_float, uni.test_int))
+        
+        uni.set_many(('test_vec2', 'test_array_float'), ((1.0, 1.5), (1.0, 2.0, 3.0, 4.0)), sort=True)
+        self.assertEqual(((1.0, 1.5), (1.0, 2.0, 3.0, 4.0)), (uni.test_vec2, uni.test_array_float))
+        
+        with self.assertRaises(AttributeError) as cm:
+            uni.set_many(('test_int', 'foobar'), (9, 1))
+        self.assertEqual('No uniform named "foobar" found', str(cm.exception))
+        self.assertEqual(8, uni.test_int)
+
+    def test_uniforms_generated(self):
+        " Uniforms of the same signature share the generated code "
+        pyshaders.SETTER_FACTORIES.clear()
+        pyshaders.GETTER_FACTORIES.clear()
+        
+        shader1 = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        setters, getters = len(pyshaders.SETTER_FACTORIES), len(pyshaders.GETTER_FACTORIES)
+        self.assertNotEqual(0, setters)
+        self.assertNotEqual(0, getters)
+        
+        shader2 = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        self.assertEqual(setters, len(pyshaders.SETTER_FACTORIES))
+        self.assertEqual(getters, len(pyshaders.GETTER_FACTORIES))
+        
+        info1, info2 = shader1.uniforms.cache['test_vec2'], shader2.uniforms.cache['test_vec2']
+        self.assertIs(info1.set.__code__, info2.set.__code__)
+        self.assertIs(info1.get.__code__, info2.get.__code__)
+        
+        shader1.use()
+        shader1.uniforms.test_vec2 = (1.0, 2.0)
+        shader2.use()
+        shader2.uniforms.test_vec2 = (3.0, 4.0)
+        self.assertEqual((3.0, 4.0), shader2.uniforms.test_vec2)
+        shader1.use()
+        self.assertEqual((1.0, 2.0), shader1.uniforms.test_vec2)
+
+    def test_uniforms_handle(self):
+        " Pre-resolved uniform handles "
+        vert = "#version 130\nin vec2 pos; void main(){ gl_Position = vec4(pos, 0.0, 1.0); }"
+        frag1 = "#version 130\nout vec4 c; uniform float a; uniform vec2 b; void main(){ c = vec4(b, a, 1.0); }"
+        frag2 = "#version 130\nout vec4 c; uniform vec2 b; void main(){ c = vec4(b, 0.0, 1.0); }"
+        
+        shader = from_string(vert, frag1)
+        uni = shader.uniforms
+        shader.use()
+        
+        a, b = uni.handle('a'), uni.handle('b')
+        self.assertIs(a, uni.handle('a'))
+        self.assertTrue(a)
+        self.assertEqual((GL_FLOAT, 1), (a.type, a.size))
+        
+        a.set(4.0)
+        b.set((1.0, 2.0))
+        self.assertEqual((4.0, (1.0, 2.0)), (a.get(), b.get()))
+        self.assertEqual(4.0, uni.a)
+        
+        with self.assertRaises(AttributeError):
+            uni.handle('foobar')
+        
+        # Link the program again without the uniform "a"
+        shader.detach(*shader.shaders())
+        objs = (ShaderObject.vertex(), ShaderObject.fragment())
+        for obj, src in zip(objs, (vert, frag2)):
+            obj.source = src
+            self.assertTrue(obj.compile())
+        shader.attach(*objs)
+        self.assertTrue(shader.link())
+        shader.use()
+        
+        self.assertFalse(a)
+        with self.assertRaises(RuntimeError):
+            a.set(1.0)
+        
+        self.assertTrue(b)
+        self.assertIs(uni.cache['b'].loc, b.loc)
+        b.set((3.0, 5.0))
+        self.assertEqual((3.0, 5.0), uni.b)
+
+    def test_uniforms_range(self):
+        " Set ranges of uniform arrays "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        
+        uni.test_array_float = (1.0, 2.0, 3.0, 4.0)
+        uni.set_range('test_array_float', 1, (8.0, 9.0))
+        self.assertEqual((1.0, 8.0, 9.0, 4.0), uni.test_array_float)
+        
+        # The last value sent is updated
+        issued = uni.stats.issued
+        uni.test_array_float = (1.0, 8.0, 9.0, 4.0)
+        self.assertEqual(issued, uni.stats.issued)
+        
+        uni.set_range('test_array_vec3', 1, array('f', (1.0, 2.0, 3.0)))
+        self.assertEqual((1.0, 2.0, 3.0), uni.test_array_vec3[1])
+        
+        # The writers are created once
+        write = uni.writer('test_array_float')
+        with mock.patch.object(pyshaders, 'create_uniform_writer', side_effect=AssertionError('writer was created again')):
+            uni.set_range('test_array_float', 0, (1.0,))
+        self.assertIs(write, uni.writer('test_array_float'))
+        
+        handle = uni.handle('test_array_float')
+        handle[2:4] = (5.0, 6.0)
+        handle[-4] = 7.0
+        self.assertEqual((7.0, 8.0, 5.0, 6.0), uni.test_array_float)
+        
+        with self.assertRaises(IndexError):
+            uni.set_range('test_array_float', 3, (1.0, 2.0))
+        with self.assertRaises(ValueError):
+            handle[0:2] = (1.0,)
+        with self.assertRaises(ValueError):
+            uni.set_range('test_array_vec3', 0, ((1.0, 2.0),))
+        self.assertEqual((7.0, 8.0, 5.0, 6.0), uni.test_array_float)
+        
+        # Deferred ranges are merged
+        uni.defer()
+        try:
+            issued = uni.stats.issued
+            handle[0] = 1.0
+            handle[3] = 4.0
+            handle[1] = 2.0
+            self.assertEqual((7.0, 8.0, 5.0, 6.0), uni.test_array_float)
+            self.assertEqual((1.0, 2.0, 5.0, 4.0), tuple(uni.read('test_array_float', shadow=True)))
+            
+            shader.use()
+            self.assertEqual((1.0, 2.0, 5.0, 4.0), uni.test_array_float)
+            self.assertEqual(issued+2, uni.stats.issued)
+            
+            # Ranges set after the whole array are written in the pending value
+            uni.test_array_float = (0.0, 0.0, 0.0, 0.0)
+            handle[1:3] = (3.0, 3.0)
+            uni.flush()
+            self.assertEqual((0.0, 3.0, 3.0, 0.0), uni.test_array_float)
+        finally:
+            uni.defer(False)
+
+    def struct_shader(self):
+        vert = "#version 130\nin vec2 pos; void main(){ gl_Position = vec4(pos, 0.0, 1.0); }"
+        frag = """#version 130
+        out vec4 c;
+        struct Light { vec3 color; float intensity; float weights[2]; };
+        uniform Light lights[2];
+        uniform Light sun;
+        void main(){ 
+            vec3 l = lights[0].color*lights[0].intensity*lights[0].weights[1] + lights[1].color*lights[1].intensity*lights[1].weights[1];
+            c = vec4(l + sun.color*sun.intensity, lights[0].weights[0]+lights[1].weights[0]+sun.weights[0]+sun.weights[1]);
+        }"""
+        return from_string(vert, frag)
+        
+    def test_uniforms_struct(self):
+        " Set structs and arrays of structs uniforms "
+        shader = self.struct_shader()
+        uni = shader.uniforms
+        shader.use()
+        
+        self.assertIn('lights[1].weights', uni)
+        self.assertIn('sun.color', uni)
+        self.assertEqual((1, 'color'), uniform_path('lights[1].color')[1:])
+        
+        class Light(object):
+            def __init__(self, color, intensity, weights):
+                self.color, self.intensity, self.weights = color, intensity, weights
+        
+        uni.sun = Light((1.0, 2.0, 3.0), 4.0, (5.0, 6.0))
+        uni.lights = ({'color': (0.5, 0.5, 0.5), 'intensity': 1.0, 'weights': (1.0, 2.0)},
+                      Light((0.0, 1.0, 0.0), 2.0, (3.0, 4.0)))
+        
+        self.assertEqual({'color': (1.0, 2.0, 3.0), 'intensity': 4.0, 'weights': (5.0, 6.0)}, uni.sun)
+        self.assertEqual((0.0, 1.0, 0.0), uni['lights[1].color'].get(shader.pid))
+        self.assertEqual((3.0, 4.0), uni.lights[1]['weights'])
+        self.assertEqual(2, len(uni.lights))
+        
+        light = uni.struct('lights')[1]
+        self.assertEqual('lights[1]', light.name)
+        light.set({'color': (1.0, 1.0, 1.0), 'intensity': 0.5, 'weights': (0.0, 0.0)})
+        self.assertEqual(0.5, uni.lights[1]['intensity'])
+        
+        # Missing members are found before any write
+        broken = Light((0.0, 0.0, 0.0), 1.0, (0.0, 0.0))
+        del broken.weights
+        with self.assertRaises(AttributeError):
+            uni.sun = broken
+        with self.assertRaises(KeyError):
+            uni.sun = {'color': (0.0, 0.0, 0.0), 'intensity': 1.0}
+        self.assertEqual(4.0, uni.sun['intensity'])
+        
+        with self.assertRaises(AttributeError):
+            uni.struct('foobar')
+            
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_uniforms_struct_numpy(self):
+        " Set arrays of structs uniforms with numpy structured arrays "
+        shader = self.struct_shader()
+        uni = shader.uniforms
+        shader.use()
+        
+        dtype = numpy.dtype([('color', numpy.float32, 3), ('intensity', numpy.float32), ('weights', numpy.float32, 2)])
+        lights = numpy.zeros(2, dtype=dtype)
+        lights['color'] = ((1.0, 2.0, 3.0), (4.0, 5.0, 6.0))
+        lights['intensity'] = (7.0, 8.0)
+        lights['weights'] = ((1.0, 2.0), (3.0, 4.0))
+        
+        uni.lights = lights
+        uni.sun = lights[1]
+        self.assertEqual((4.0, 5.0, 6.0), uni.lights[1]['color'])
+        self.assertEqual((1.0, 2.0), uni.lights[0]['weights'])
+        self.assertEqual(8.0, uni.sun['intensity'])
+
+    def test_uniforms_lazy(self):
+        " Lazy reflection of the uniforms and attributes "
+        pyshaders.lazy_reflection(True)
+        try:
+            shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+            uni, attr = shader.uniforms, shader.attributes
+            cache = pyshaders.ShaderAccessor.cache
+            
+            # Nothing is reflected at link time
+            with self.assertRaises(AttributeError):
+                cache.__get__(uni)
+            with self.assertRaises(AttributeError):
+                cache.__get__(attr)
+                
+            shader.use()
+            uni.test_vec2 = (4.0, 5.0)
+            self.assertIn('test_float', uni._lazy)
+            self.assertNotIn('test_vec2', uni._lazy)
+            self.assertEqual((4.0, 5.0), uni.test_vec2)
+            uni.update({'test_float': 2.5})
+            self.assertEqual(2.5, uni.test_float)
+            self.assertNotIn('test_float', uni._lazy)
+            self.assertIn('vert', attr)
+            
+            # Linking again removes the caches
+            shader.link()
+            self.assertEqual({}, uni._lazy)
+            with self.assertRaises(AttributeError):
+                cache.__get__(uni)
+            self.assertEqual((2.0, 3.0), uni.test_vec2)     # Linking restores the initial values
+            
+            # Caches with handles are reloaded immediately
+            handle = uni.handle('test_int')
+            shader.link()
+            self.assertIs(uni.cache['test_int'].set, handle.set)
+            handle.set(7)
+            self.assertEqual(7, uni.test_int)
+        finally:
+            pyshaders.lazy_reflection(False)
+
+    def test_restore_reflection(self):
+        " Rebuild the caches from reflection metadata "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        meta = json.loads(json.dumps(shader.reflection()))
+        
+        shader2 = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        shader2.restore_reflection(meta, verify=True)
+        self.assertEqual(sorted(shader.uniforms.cache.keys()), sorted(shader2.uniforms.cache.keys()))
+        self.assertIn('vert', shader2.attributes)
+        
+        shader2.use()
+        shader2.uniforms.test_ivec2 = (8, 9)
+        self.assertEqual((8, 9), shader2.uniforms.test_ivec2)
+        
+        del meta['uniforms'][0]
+        with self.assertRaises(ValueError):
+            shader2.restore_reflection(meta, verify=True)
+
+    def test_uniforms_reserved_names(self):
+        " Uniforms named like the accessor internals "
+        vert = "#version 130\nin vec2 pos; void main(){ gl_Position = vec4(pos, 0.0, 1.0); }"
+        frag = "#version 130\nout vec4 c; uniform float shadow; uniform int dirty; uniform float lazy; void main(){ c = vec4(shadow, float(dirty), lazy, 1.0); }"
+        shader = from_string(vert, frag)
+        uni = shader.uniforms
+        shader.use()
+        
+        uni.shadow = 1.5
+        uni.dirty = 4
+        uni.lazy = 2.5
+        self.assertEqual((1.5, 4, 2.5), (uni.shadow, uni.dirty, uni.lazy))
+        
+        uni.invalidate()
+        shader.reload()
+        uni.shadow = 3.0
+        self.assertEqual(3.0, uni.shadow)
+        
+        # Uniforms named like the accessor attributes are read with a handle
+        frag = "#version 130\nout vec4 c; uniform float stats; uniform float flush; void main(){ c = vec4(stats, flush, 0.0, 1.0); }"
+        shader = from_string(vert, frag)
+        uni = shader.uniforms
+        shader.use()
+        
+        uni.stats = 2.0
+        uni.handle('flush').set(4.0)
+        self.assertIsInstance(uni.stats, pyshaders.UniformStats)
+        self.assertEqual((2.0, 4.0), (uni.handle('stats').get(), uni.handle('flush').get()))
+        uni.flush()
+
+    def test_uniforms_deferred(self):
+        " Deferred uniforms writes "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        stats = uni.stats
+        shader.use()
+        uni.test_float = 1.0
+        stats.reset()
+        
+        # The setters are rebuilt without querying the program
+        with mock.patch.object(pyshaders.ShaderUniformAccessor, 'query', side_effect=AssertionError('uniforms were queried')):
+            uni.defer()
+        self.assertEqual(1.0, uni.test_float)
+        shader.clear()
+        
+        # Program is not in use, nothing is sent
+        for i in range(10):
+            uni.test_float = float(i)
+            uni.test_vec2 = array('f', (i, i))
+        uni.test_int = 3
+        self.assertEqual(3, len(uni._dirty))
+        self.assertEqual((0, 0), (stats.issued, stats.skipped))
+        
+        shader.use()
+        self.assertEqual(0, len(uni._dirty))
+        self.assertEqual((3, 0), (stats.issued, stats.skipped))
+        self.assertEqual((9.0, (9.0, 9.0), 3), (uni.test_float, uni.test_vec2, uni.test_int))
+        
+        uni.test_float = 2.0
+        uni.test_int = 3
+        uni.flush()
+        self.assertEqual((4, 1), (stats.issued, stats.skipped))
+        self.assertEqual(2.0, uni.test_float)
+        
+        # Pending values are sent when the deferred mode is disabled
+        uni.test_float = 5.0
+        uni.defer(False)
+        self.assertEqual(5.0, uni.test_float)
+        uni.test_float = 6.0
+        self.assertEqual(6.0, uni.test_float)
+
+    def test_read_uniforms(self):
+        " Read uniforms values in buffers "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        pyshaders.transpose_matrices(True)
+        
+        uni.test_vec3 = (1.0, 2.0, 3.0)
+        self.assertEqual([1.0, 2.0, 3.0], list(uni.read('test_vec3')))
+        
+        out = array('f', [0.0]*8)
+        self.assertIs(out, uni.read('test_vec3', out))
+        self.assertEqual([1.0, 2.0, 3.0, 0.0, 0.0], list(out[0:5]))
+        
+        uni.test_array_vec3 = ((8.0, 6.0, 80.0), (5.0, 17.0, 45.0))
+        self.assertEqual([8.0, 6.0, 80.0, 5.0, 17.0, 45.0], list(uni.read('test_array_vec3')))
+        self.assertEqual(2, len(uni.element_locations('test_array_vec3')))
+        
+        # Matrices can be assigned back, whatever the transposition
+        values = array('f', [8.0, 9.0, 10.0, 20.0, 11.0, 2.0])
+        for transpose in (True, False):
+            pyshaders.transpose_matrices(transpose)
+            uni.test_mat2x3 = values
+            self.assertEqual(list(values), list(uni.read('test_mat2x3')))
+            self.assertEqual(list(values), list(uni.read('test_mat2x3', shadow=True)))
+            
+        pyshaders.transpose_matrices(True)
+        mats = array('f', range(12))
+        uni.test_array_mat2 = mats
+        self.assertEqual(list(mats), list(uni.read('test_array_mat2')))
+        
+        # Shadow values are read without OpenGL
+        glUniform3f(uni['test_vec3'].loc, 5.0, 5.0, 5.0)
+        self.assertEqual([1.0, 2.0, 3.0], list(uni.read('test_vec3', shadow=True)))
+        self.assertEqual([5.0, 5.0, 5.0], list(uni.read('test_vec3')))
+        
+        uni.defer()
+        uni.test_float = 7.0
+        self.assertEqual([7.0], list(uni.read('test_float', shadow=True)))
+        uni.defer(False)
+        
+        with self.assertRaises(TypeError):
+            uni.read('test_vec3', array('d', [0.0]*3))
+        with self.assertRaises(ValueError):
+            uni.read('test_vec3', array('f', [0.0]*2))
+        with self.assertRaises(AttributeError):
+            uni.read('foobar')
+            
+    @unittest.skipUnless(numpy is not None, 'numpy is not installed')
+    def test_read_uniforms_numpy(self):
+        " Read uniforms values in numpy arrays "
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni = shader.uniforms
+        shader.use()
+        pyshaders.transpose_matrices(True)
+        
+        mats = numpy.arange(12, dtype=numpy.float32).reshape((3, 2, 2))
+        uni.test_array_mat2 = mats
+        out = numpy.zeros((3, 2, 2), dtype=numpy.float32)
+        uni.read('test_array_mat2', out)
+        self.assertTrue((mats == out).all())
         
     def test_get_set_unforms_fail(self):
         " Get / Set missing uniforms "
@@ -711,12 +1304,402 @@ class TestShaders(unittest.TestCase):
         vert.close()
         frag.close()
         
+    def test_from_string_pool(self):
+        " Test from_string with shared shader objects "
+        pool = ShaderObjectPool()
+        srcs = []
+        for path in (vert_path('shader2'), frag_path('shader2'), frag_path('frag_lib')):
+            with open(path) as f:
+                srcs.append(f.read())
+        
+        shader = from_string(srcs[0], srcs[1:], pool=pool)
+        shader2 = from_string(srcs[0], srcs[1:], pool=pool)
+        self.assertEqual(3, pool.compiled, 'shared objects were compiled more than once')
+        self.assertEqual(3, len(pool))
+        
+        objs = shader.shaders()
+        for obj in objs:
+            self.assertIn(obj, pool)
+            self.assertIn(obj, shader2.shaders())
+        
+        del shader
+        gc.collect()
+        for obj in objs:
+            self.assertTrue(obj.valid(), 'shared object was freed with its program')
+        self.assertTrue(shader2.link(), 'shared objects cannot be linked again')
+        
+        pool.clear()
+        self.assertFalse(any(obj.pooled for obj in shader2.shaders()), 'cleared objects are still pooled')
+        del shader2
+        gc.collect()
+        for obj in objs:
+            self.assertFalse(obj.valid(), 'shared object was not freed')
+
+    def test_pool_freed(self):
+        " Test that a pool freed without being cleared gives back its shader objects "
+        pool = ShaderObjectPool()
+        obj = pool.get(GL_VERTEX_SHADER, 'void main(){ gl_Position = vec4(0.0); }')
+        sid = obj.sid.value
+        self.assertTrue(obj.pooled)
+
+        del pool
+        gc.collect()
+        self.assertFalse(obj.pooled, 'object is still pooled')
+        self.assertNotIn(sid, pyshaders.POOLED_SHADERS)
+
+        del obj
+        gc.collect()
+        self.assertFalse(ShaderObject(sid).valid(), 'shader object was not freed')
+
+    def test_build_async(self):
+        " Test build_async "
+        with open(vert_path('shader1')) as vert, open(frag_path('shader1')) as frag:
+            pending = build_async(vert.read(), frag.read())
+        
+        while not pending.done():
+            pass
+        
+        shader = pending.result()
+        self.assertTrue(shader.valid(), 'generated shader is not valid')
+        self.assertEqual(23, len(shader.uniforms))
+        self.assertIs(shader, pending.result())
+        
+    def test_build_async_bad_compilation(self):
+        " Test build_async with bad shaders "
+        with open(vert_path('shader_bad')) as vert, open(frag_path('shader1')) as frag:
+            pending = build_async(vert.read(), frag.read())
+        
+        with self.assertRaises(ShaderCompilationError, msg='invalid shader was compiled') as cm:
+            pending.result()
+            
+        self.assertNotEqual(0, len(cm.exception.logs), 'logs are empty')
+        self.assertIs(cm.exception, pending.error)
+        
+    def test_program_batch(self):
+        " Test building many programs with ProgramBatch "
+        srcs = {}
+        for name in ('shader1', 'shader2', 'shader_bad'):
+            with open(vert_path(name)) as vert, open(frag_path(name)) as frag:
+                srcs[name] = vert.read(), frag.read()
+        with open(frag_path('frag_lib')) as f:
+            lib = f.read()
+        
+        batch = ProgramBatch([srcs['shader1']])
+        self.assertEqual(1, batch.add(*srcs['shader_bad']))
+        self.assertEqual(2, batch.add(srcs['shader2'][0], (srcs['shader2'][1], lib)))
+        self.assertEqual(3, len(batch))
+        
+        # Record the order of the compilations, links and status queries
+        names = ('glCompileShader', 'glLinkProgram', 'glGetShaderiv', 'glGetProgramiv')
+        calls = mock.Mock()
+        for name in names:
+            calls.attach_mock(mock.Mock(wraps=getattr(pyshaders, name)), name)
+        with mock.patch.multiple(pyshaders, **{name: getattr(calls, name) for name in names}):
+            shader1, error, shader2 = batch.build()
+            
+        order = [call[0] for call in calls.mock_calls]
+        queries = [i for i, name in enumerate(order) if name in ('glGetShaderiv', 'glGetProgramiv')]
+        self.assertEqual(3, order.count('glLinkProgram'))
+        self.assertNotEqual([], queries)
+        self.assertLess(max(i for i, name in enumerate(order) if name in names[0:2]), queries[0],
+                        'status queried before every program was linked')
+        
+        self.assertTrue(shader1.valid(), 'generated shader is not valid')
+        self.assertEqual(23, len(shader1.uniforms))
+        self.assertTrue(shader2.valid(), 'generated shader is not valid')
+        self.assertIsInstance(error, ShaderCompilationError)
+        self.assertNotEqual(0, len(error.logs), 'logs are empty')
+        
+    def test_from_files_names_async(self):
+        " Test loading a program from a coroutine "
+        scheduler = GLScheduler()
+        
+        async def load():
+            task = asyncio.ensure_future(from_files_names_async(vert_path('shader2'), 
+              (frag_path('shader2'), frag_path('frag_lib')), scheduler))
+            while not task.done():
+                scheduler.pump()    # Done by the render loop
+                await asyncio.sleep(0)
+            return task.result()
+        
+        loop = asyncio.new_event_loop()
+        try:
+            shader = loop.run_until_complete(load())
+        finally:
+            loop.close()
+            
+        self.assertTrue(shader.valid(), 'generated shader is not valid')
+        self.assertEqual(0, len(scheduler))
+        
+    def test_scheduler(self):
+        " Test the GLScheduler "
+        scheduler = GLScheduler()
+        future = scheduler.call(current_program)
+        bad_future = scheduler.build('not glsl', 'not glsl')
+        
+        self.assertFalse(future.done())
+        self.assertEqual(1, scheduler.pump(max_calls=1))
+        self.assertTrue(future.done())
+        
+        while not bad_future.done():
+            scheduler.pump()
+        self.assertIsInstance(bad_future.exception(), ShaderCompilationError)
+        
+    def test_from_files_trusted(self):
+        " Test loading shaders in trusted mode "
+        with mock.patch.object(pyshaders, 'glGetShaderiv', wraps=pyshaders.glGetShaderiv) as get_shader, \
+          mock.patch.object(pyshaders, 'glGetProgramiv', wraps=pyshaders.glGetProgramiv) as get_program:
+            shader = from_files_names(vert_path('shader1'), frag_path('shader1'), trusted=True)
+            
+        # Only the link status is checked
+        self.assertNotIn(GL_COMPILE_STATUS, [call[0][1] for call in get_shader.call_args_list], 'compile status was queried')
+        self.assertIn(GL_LINK_STATUS, [call[0][1] for call in get_program.call_args_list], 'link status was not queried')
+        self.assertTrue(shader.valid(), 'generated shader is not valid')
+        self.assertEqual(23, len(shader.uniforms))
+        
+        pyshaders.trust_shaders(True)
+        try:
+            with self.assertRaises(ShaderCompilationError, msg='invalid shader was compiled') as cm:
+                from_files_names(vert_path('shader_bad'), frag_path('shader_bad'))
+            self.assertNotEqual(0, len(cm.exception.logs), 'compilation logs were not diagnosed')
+                
+            with self.assertRaises(ShaderCompilationError, msg='invalid shader was linked') as cm:
+                from_files_names(vert_path('shader2'), frag_path('shader2'))
+            self.assertIn('secret_method', cm.exception.logs, 'link logs were not returned')
+        finally:
+            pyshaders.trust_shaders(False)
+        
     def test_from_string(self):
         """
         Because from_string is used internally by from_files and from_file_names,
         I think it is safe to say the function is well tested
         """
         
+class TestProgramCache(unittest.TestCase):
+    
+    def sources(self, name='shader1'):
+        with open(vert_path(name)) as vert, open(frag_path(name)) as frag:
+            return vert.read(), frag.read()
+    
+    def test_acquire_release(self):
+        " Test program sharing and reference counting "
+        cache = ProgramCache()
+        vert, frag = self.sources()
+        
+        prog = cache.acquire(vert, frag)
+        prog2 = cache.acquire([vert], [frag])
+        self.assertIs(prog, prog2, 'program was not shared')
+        self.assertEqual(2, cache.refcount(prog))
+        self.assertIn(prog, cache)
+        
+        pid = prog.pid
+        cache.release(prog)
+        self.assertEqual(1, len(cache))
+        cache.release(prog2)
+        self.assertEqual(0, len(cache))
+        self.assertNotIn(prog, cache)
+        
+        with self.assertRaises(ValueError):
+            cache.release(prog)
+            
+        del prog, prog2
+        gc.collect()
+        self.assertEqual(GL_FALSE, glIsProgram(pid), 'Program was not freed')
+        
+    def test_max_idle(self):
+        " Test that released programs are kept alive in LRU mode "
+        cache = ProgramCache(max_idle=1)
+        vert, frag = self.sources()
+        
+        prog = cache.acquire(vert, frag)
+        cache.release(prog)
+        self.assertIn(prog, cache)
+        self.assertIs(prog, cache.acquire(vert, frag), 'idle program was not reused')
+        cache.release(prog)
+        
+        prog2 = cache.acquire(vert, frag+'\n// variant')
+        cache.release(prog2)
+        self.assertNotIn(prog, cache)
+        self.assertIn(prog2, cache)
+        
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        
+class TestPreprocessor(unittest.TestCase):
+    
+    def write(self, path, src):
+        with open(path, 'w') as f:
+            f.write(src)
+    
+    def test_include(self):
+        " Test loading a shader with includes "
+        pp = ShaderPreprocessor()
+        shader = from_files_names(vert_path('shader2'), frag_path('shader_include'), preprocessor=pp)
+        self.assertTrue(shader.valid(), 'generated shader is not valid')
+        
+        pp = ShaderPreprocessor()
+        src = pp.preprocess(frag_path('shader_include'))
+        self.assertIn('vec4 secret_method()', src)
+        self.assertNotIn('#include', src)
+        self.assertNotIn('#version 330', src)
+        self.assertTrue(src.startswith('#version 130\n#line 1 0\n'))
+        self.assertIn('#line 0 1\n', src)
+        self.assertIn('#line 5 0\n', src)
+        self.assertEqual(os.path.abspath(frag_path('frag_lib')), pp.file_name(1))
+        
+    def test_include_cache(self):
+        " Test that only the files that changed are read again "
+        path = tempfile.mkdtemp()
+        try:
+            main, lib = os.path.join(path, 'main.frag'), os.path.join(path, 'lib.glsl')
+            self.write(main, '#version 330\n#include "lib.glsl"\nvoid main() {}')
+            self.write(lib, '#pragma once\nfloat foo() { return 1.0; }')
+            
+            pp = ShaderPreprocessor()
+            pp.preprocess(main)
+            pp.preprocess(main)
+            self.assertEqual(2, pp.reads)
+            self.assertEqual({os.path.abspath(lib)}, pp.dependencies(main))
+            
+            self.write(lib, 'float foo() { return 2.0; }')
+            os.utime(lib, ns=(0, 0))
+            src = pp.preprocess(main)
+            self.assertEqual(3, pp.reads)
+            self.assertIn('return 2.0', src)
+            
+            self.write(main, '#include "missing.glsl"')
+            with self.assertRaises(ShaderCompilationError):
+                pp.preprocess(main)
+        finally:
+            shutil.rmtree(path)
+        
+    def test_logs(self):
+        " Test that the included files are listed in the compilation logs "
+        path = tempfile.mkdtemp()
+        try:
+            main = os.path.join(path, 'main.frag')
+            self.write(main, '#version 130\n#include "lib.glsl"\nvoid main() {}')
+            self.write(os.path.join(path, 'lib.glsl'), 'float foo() { return x; }')
+            
+            pp = ShaderPreprocessor()
+            with self.assertRaises(ShaderCompilationError) as cm:
+                from_files_names(vert_path('shader1'), main, preprocessor=pp)
+            self.assertIn('2: {}'.format(os.path.join(path, 'lib.glsl')), cm.exception.logs)
+        finally:
+            shutil.rmtree(path)
+        
+class TestWatcher(unittest.TestCase):
+    
+    frag = """#version 130
+out vec4 color_frag;
+uniform vec4 color;
+uniform float {name} = 1.0;
+void main() {{ color_frag = color * {name}; }}"""
+    
+    def write(self, path, src):
+        with open(path, 'w') as f:
+            f.write(src)
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns+1000))  # Make sure the modification time changes
+    
+    def test_reload(self):
+        " Test that programs are rebuilt when their files change "
+        path = tempfile.mkdtemp()
+        try:
+            frag = os.path.join(path, 'main.frag')
+            self.write(frag, self.frag.format(name='scale'))
+            
+            ShaderProgram.clear()
+            watcher = ShaderWatcher()
+            shader = watcher.load(vert_path('shader1'), frag)
+            shader2 = watcher.load(vert_path('shader1'), frag_path('shader1'))
+            self.assertEqual(3, len(watcher.pool), 'vertex shader was not shared')
+            with shader.using():
+                shader.uniforms.color = (1.0, 2.0, 3.0, 4.0)
+            pid, pid2 = shader.pid.value, shader2.pid.value
+                
+            watcher.poll()
+            self.assertEqual([], watcher.update(), 'programs rebuilt without changes')
+            
+            self.write(frag, self.frag.format(name='factor'))
+            watcher.poll()
+            self.assertEqual([shader], watcher.update())
+            self.assertEqual([], watcher.errors)
+            self.assertNotEqual(pid, shader.pid.value, 'program was not linked again')
+            self.assertEqual(pid2, shader2.pid.value, 'unrelated program was linked again')
+            self.assertIn('factor', shader.uniforms)
+            self.assertEqual((1.0, 2.0, 3.0, 4.0), shader.uniforms.color, 'uniform value was not restored')
+            self.assertEqual(3, len(watcher.pool), 'old shader object was not removed')
+            
+            # Pending deferred values are kept
+            shader.uniforms.defer()
+            shader.uniforms.color = (5.0, 6.0, 7.0, 8.0)
+            self.write(frag, self.frag.format(name='scale'))
+            watcher.poll()
+            self.assertEqual([shader], watcher.update())
+            self.assertEqual((5.0, 6.0, 7.0, 8.0), shader.uniforms.color, 'deferred value was dropped')
+            shader.uniforms.defer(False)
+            
+            # Errors keep the previous program
+            pid = shader.pid.value
+            self.write(frag, 'not glsl')
+            watcher.poll()
+            self.assertEqual([], watcher.update())
+            self.assertEqual(1, len(watcher.errors))
+            self.assertEqual(pid, shader.pid.value)
+            self.assertTrue(shader.valid())
+        finally:
+            shutil.rmtree(path)
+            
+    def test_missing_include(self):
+        " Test that an include of a missing file is an error checked again by the next update "
+        path = tempfile.mkdtemp()
+        try:
+            frag = os.path.join(path, 'main.frag')
+            self.write(frag, self.frag.format(name='scale'))
+            
+            ShaderProgram.clear()
+            watcher = ShaderWatcher()
+            shader = watcher.load(vert_path('shader1'), frag)
+            pid = shader.pid.value
+            
+            lib = os.path.join(path, 'lib.glsl')
+            self.write(frag, self.frag.format(name='factor').replace('\n', '\n#include "lib.glsl"\n', 1))
+            watcher.poll()
+            self.assertEqual([], watcher.update())
+            self.assertEqual(1, len(watcher.errors))
+            self.assertIsInstance(watcher.errors[0], ShaderCompilationError)
+            self.assertEqual(pid, shader.pid.value)
+            self.assertIn(frag, watcher.changed, 'failed file was not kept')
+            
+            self.write(lib, '#define LIB 1')
+            self.assertEqual([shader], watcher.update())
+            self.assertEqual([], watcher.errors)
+            self.assertIn('factor', shader.uniforms)
+            self.assertIn(lib, watcher.mtimes, 'included file is not watched')
+        finally:
+            shutil.rmtree(path)
+            
+    def test_thread(self):
+        " Test the background polling thread "
+        path = tempfile.mkdtemp()
+        try:
+            frag = os.path.join(path, 'main.frag')
+            self.write(frag, self.frag.format(name='scale'))
+            
+            watcher = ShaderWatcher(interval=0.01)
+            shader = watcher.load(vert_path('shader1'), frag)
+            watcher.start()
+            self.write(frag, self.frag.format(name='factor'))
+            for i in range(500):
+                if len(watcher.changed) > 0:
+                    break
+                watcher.stopped.wait(0.01)
+            watcher.stop()
+            
+            self.assertEqual([shader], watcher.update())
+        finally:
+            shutil.rmtree(path)
+        
 class TestExtensions(unittest.TestCase):
     
     @unittest.skipUnless(check_extension('uint_uniforms'), "extension uint_uniforms is not supported")    
@@ -887,6 +1870,294 @@ class TestExtensions(unittest.TestCase):
         self.assertEqual((((1.0, 2.0), (3.0, 4.0)),
                           ((10.0, 20.0), (30.0, 40.0))), uni.test_dmat2_2)  
         
+    @unittest.skipUnless(check_extension('program_binary'), "extension program_binary is not supported")
+    def test_program_binary(self):
+        " Test the on-disk program binary cache "
+        if not extension_loaded('program_binary'):
+            load_extension('program_binary')
+        
+        path = tempfile.mkdtemp()
+        try:
+            cache = pyshaders.ProgramBinaryCache(path)
+            shader = from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            self.assertEqual((0, 1), (cache.hits, cache.misses))
+            self.assertEqual(['.bin', '.json'], sorted(os.path.splitext(f)[1] for f in os.listdir(path)), 'binary was not saved')
+            
+            # The caches are restored from the reflection metadata, without querying the program
+            def query(*args):
+                raise AssertionError('program was queried')
+            with mock.patch.object(pyshaders.ShaderUniformAccessor, 'query', query), \
+              mock.patch.object(pyshaders.ShaderAttributeAccessor, 'query', query):
+                shader2 = from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            self.assertNotEqual(shader, shader2)
+            self.assertEqual(23, len(shader2.uniforms))
+            self.assertEqual(0, shader2.shaders_count)
+            self.assertEqual(shader.reflection(), shader2.reflection())
+            
+            shader2.use()
+            shader2.uniforms.test_vec2 = (5.0, 6.0)
+            self.assertEqual((5.0, 6.0), shader2.uniforms.test_vec2)
+            
+            # The size is tracked without listing the directory
+            self.assertEqual(sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)), cache.size)
+            self.assertEqual(cache.size, pyshaders.ProgramBinaryCache(path).size)
+            
+            # Invalid metadata is detected in verify mode
+            fname = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.bin')][0]
+            with open(cache.reflection_filename(fname), 'r+') as f:
+                meta = json.load(f)
+                meta['reflection']['uniforms'][0][3] += 100
+                f.seek(0)
+                json.dump(meta, f)
+                f.truncate()
+            
+            pyshaders.verify_reflection(True)
+            try:
+                with self.assertRaises(ValueError):
+                    from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            finally:
+                pyshaders.verify_reflection(False)
+            
+            # Metadata without a binary is evicted
+            orphan = os.path.join(path, 'orphan.json')
+            with open(orphan, 'w') as f:
+                f.write('{}')
+            cache.evict()
+            self.assertFalse(os.path.exists(orphan), 'orphan metadata was not evicted')
+            self.assertEqual(['.bin', '.json'], sorted(os.path.splitext(f)[1] for f in os.listdir(path)))
+            
+            # Binaries are evicted when the cache is full
+            cache.max_size = 0
+            cache.evict()
+            self.assertEqual(0, len(os.listdir(path)), 'binary was not evicted')
+            self.assertEqual(0, cache.size)
+        finally:
+            shutil.rmtree(path)
+    
+    @unittest.skipUnless(check_extension('program_binary'), "extension program_binary is not supported")
+    def test_program_binary_rejected(self):
+        " Test that programs are compiled when the driver rejects a cached binary "
+        if not extension_loaded('program_binary'):
+            load_extension('program_binary')
+        
+        path = tempfile.mkdtemp()
+        try:
+            cache = pyshaders.ProgramBinaryCache(path)
+            from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            
+            fname = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.bin')][0]
+            with open(fname, 'r+b') as f:
+                format = f.read(4)
+                f.seek(0)
+                f.write(format + b'not a program binary'*64)
+                f.truncate()
+            
+            shader = from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            self.assertEqual((0, 2), (cache.hits, cache.misses))
+            self.assertNotEqual(0, shader.shaders_count, 'program was not compiled from the sources')
+            self.assertEqual(23, len(shader.uniforms))
+            shader.use()
+            shader.uniforms.test_float = 8.0
+            self.assertEqual(8.0, shader.uniforms.test_float)
+            
+            # The rejected binary is replaced
+            shader2 = from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            self.assertEqual((1, 2), (cache.hits, cache.misses))
+            self.assertEqual(0, shader2.shaders_count)
+            
+            # Binaries of an unknown format are rejected without being sent to the driver
+            with open(fname, 'r+b') as f:
+                f.write(b'\xff\xff\x00\x00')
+            shader3 = from_files_names(vert_path('shader1'), frag_path('shader1'), cache=cache)
+            self.assertEqual((1, 3), (cache.hits, cache.misses))
+            self.assertNotEqual(0, shader3.shaders_count, 'program was not compiled from the sources')
+        finally:
+            shutil.rmtree(path)
+    
+    @unittest.skipUnless(check_extension('uniform_blocks'), "extension uniform_blocks is not supported")
+    def test_uniform_blocks(self):
+        " Test the uniform blocks reflection, layout and upload "
+        if not extension_loaded('uniform_blocks'):
+            load_extension('uniform_blocks')
+        
+        vert = """
+        #version 330
+        layout(std140) uniform Camera {
+            mat4 view;
+            vec3 position;
+            float scale;
+            vec2 offsets[3];
+            mat3 normal;
+            int flags;
+        };
+        in vec3 pos;
+        void main() {
+            vec3 p = (pos + position) * scale + vec3(offsets[0] + offsets[1] + offsets[2], float(flags));
+            gl_Position = view * vec4(normal * p, 1.0);
+        }
+        """
+        frag = """
+        #version 330
+        out vec4 color;
+        void main() { color = vec4(1.0); }
+        """
+        shader = from_string(vert, frag)
+        info = shader.uniform_blocks()['Camera']
+        self.assertEqual(1, shader.uniform_blocks_count)
+        self.assertEqual(['view', 'position', 'scale', 'offsets', 'normal', 'flags'], [m.name for m in info.members])
+        
+        declaration = [('view', GL_FLOAT_MAT4), ('position', GL_FLOAT_VEC3), ('scale', GL_FLOAT),
+                       ('offsets', GL_FLOAT_VEC2, 3), ('normal', GL_FLOAT_MAT3), ('flags', GL_INT)]
+        
+        # std140 matches the driver
+        members, size = pyshaders.block_layout(declaration, 'std140')
+        self.assertEqual(info.data_size, size)
+        for member, driver_member in zip(members, info.members):
+            self.assertEqual(driver_member[0:6], member[0:6])
+            
+        members, size = pyshaders.block_layout(declaration, 'std430')
+        self.assertEqual([0, 64, 76, 80, 112, 160], [m.offset for m in members])
+        self.assertEqual((8, 16), (members[3].array_stride, members[4].matrix_stride))
+        self.assertEqual(176, size)
+        
+        # Values
+        block = pyshaders.UniformBlock.from_program(shader, 'Camera')
+        block2 = pyshaders.UniformBlock.from_layout(declaration)
+        mat3 = ((1.0, 2.0, 3.0), (4.0, 5.0, 6.0), (7.0, 8.0, 9.0))
+        values = {'scale': 2.0, 'position': (1.0, 2.0, 3.0), 'offsets': ((1.0, 2.0), (3.0, 4.0), (5.0, 6.0)),
+                  'normal': mat3, 'flags': 3}
+        block.update(values)
+        block2.update(values)
+        self.assertEqual(bytes(block.data), bytes(block2.data))
+        
+        for name, value in values.items():
+            self.assertEqual(value, block[name])
+            
+        # Matrices are column major in the buffer, transposed like the uniforms
+        self.assertEqual(4.0, struct.unpack_from('f', block.data, 128+4)[0])
+        pyshaders.transpose_matrices(False)
+        block['normal'] = mat3
+        self.assertEqual(2.0, struct.unpack_from('f', block.data, 128+4)[0])
+        pyshaders.transpose_matrices(True)
+        
+        with self.assertRaises(IndexError):
+            block['position'] = (1.0, 2.0, 3.0, 4.0)
+        with self.assertRaises(TypeError):
+            block['flags'] = 1.5
+        with self.assertRaises(KeyError):
+            block['foo'] = 1.0
+            
+        # Upload and binding
+        block.bind(2)
+        shader.bind_uniform_block('Camera', 2)
+        self.assertEqual(2, shader.uniform_blocks()['Camera'].binding)
+        self.assertFalse(block.dirty)
+        
+        buf = (c_char*block.size)()
+        glBindBuffer(GL_UNIFORM_BUFFER, block.buffer)
+        glGetBufferSubData(GL_UNIFORM_BUFFER, 0, block.size, buf)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self.assertEqual(bytes(block.data), buf.raw)
+        
+        with self.assertRaises(AttributeError):
+            shader.bind_uniform_block('Foo', 2)
+            
+    @unittest.skipUnless(check_extension('uniform_blocks'), "extension uniform_blocks is not supported")
+    def test_uniform_blocks_struct_arrays(self):
+        " Test the names of the struct arrays members of an uniform block "
+        if not extension_loaded('uniform_blocks'):
+            load_extension('uniform_blocks')
+        
+        vert = """
+        #version 330
+        struct Light { vec3 color; float weights[2]; };
+        layout(std140) uniform Lights {
+            Light lights[2];
+        };
+        in vec3 pos;
+        void main() {
+            vec3 c = lights[0].color * lights[0].weights[1] + lights[1].color * lights[1].weights[1];
+            gl_Position = vec4(pos * c, 1.0);
+        }
+        """
+        frag = """
+        #version 330
+        out vec4 color;
+        void main() { color = vec4(1.0); }
+        """
+        shader = from_string(vert, frag)
+        names = [m.name for m in shader.uniform_blocks()['Lights'].members]
+        self.assertEqual(['lights[0].color', 'lights[0].weights', 'lights[1].color', 'lights[1].weights'], names)
+    
+    @unittest.skipUnless(check_extension('program_uniforms'), "extension program_uniforms is not supported")
+    def test_program_uniforms(self):
+        " Test setting uniforms without using the program "
+        if not extension_loaded('program_uniforms'):
+            load_extension('program_uniforms')
+        
+        try:
+            shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+            uni = shader.uniforms
+            shader.clear()
+            
+            uni.test_vec3 = (1.0, 2.0, 3.0)
+            uni.test_mat2 = ((5.0, 8.0), (2.0, 4.0))
+            uni.test_array_float = (1.0, 2.0)
+            self.assertIsNone(current_program())
+            self.assertEqual((1.0, 2.0, 3.0), uni.test_vec3)
+            self.assertEqual(((5.0, 8.0), (2.0, 4.0)), uni.test_mat2)
+            self.assertEqual((1.0, 2.0, 0.0, 0.0), uni.test_array_float)
+            
+            uni.test_vec3 = (1.0, 2.0, 3.0)
+            self.assertEqual((3, 1), (uni.stats.issued, uni.stats.skipped))
+            
+            # Programs built without direct uniforms must be in use
+            pyshaders.direct_uniforms(False)
+            shader2 = from_files_names(vert_path('shader1'), frag_path('shader1'))
+            with self.assertRaises(pyglet.gl.lib.GLException):
+                shader2.uniforms.test_int = 8
+        finally:
+            pyshaders.direct_uniforms(False)
+    
+    @unittest.skipUnless(check_extension('program_interface_query'), "extension program_interface_query is not supported")
+    def test_program_interface_query(self):
+        " Test the reflection with glGetProgramResourceiv "
+        if not extension_loaded('program_interface_query'):
+            load_extension('program_interface_query')
+        
+        shader = from_files_names(vert_path('shader1'), frag_path('shader1'))
+        uni, attr = shader.uniforms, shader.attributes
+        
+        # Same results as the fallback
+        fallback = pyshaders.ShaderAccessor.query
+        self.assertEqual(sorted(fallback(uni, shader, 'max_uniform_length', 'uniforms_count', glGetActiveUniform, glGetUniformLocation)),
+                         sorted(uni.query(shader)))
+        self.assertEqual(sorted(fallback(attr, shader, 'max_attribute_length', 'attributes_count', glGetActiveAttrib, glGetAttribLocation)),
+                         sorted(attr.query(shader)))
+        
+        self.assertEqual(uni.cache['test_array_vec3'].size, 2)
+        shader.use()
+        uni.test_array_vec3 = ((1.0, 2.0, 3.0), (4.0, 5.0, 6.0))
+        self.assertEqual(((1.0, 2.0, 3.0), (4.0, 5.0, 6.0)), uni.test_array_vec3)
+    
+    @unittest.skipUnless(check_extension('parallel_shader_compile'), "extension parallel_shader_compile is not supported")
+    def test_parallel_shader_compile(self):
+        " Test the completion status polling "
+        if not extension_loaded('parallel_shader_compile'):
+            load_extension('parallel_shader_compile')
+        
+        self.assertTrue(pyshaders.PARALLEL_COMPILE)
+        with open(vert_path('shader1')) as vert, open(frag_path('shader1')) as frag:
+            pending = build_async(vert.read(), frag.read())
+        
+        while not pending.done():
+            pass
+        
+        self.assertEqual(GL_TRUE, pending.program.completion_status)
+        self.assertTrue(pending.result().valid(), 'generated shader is not valid')
+    
     @unittest.skipUnless(check_extension('pyglbuffers_bindings'), "extension pyglbuffers_bindings is not supported")    
     def test_glbuffers(self):
         from pyglbuffers import Buffer